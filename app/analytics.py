@@ -0,0 +1,285 @@
+import os
+import json
+import shutil
+import argparse
+import pandas as pd
+from utils import load_batch_versions, load_batch_results
+from config import analytics_store_path
+
+# Tables of the analytics store, each partitioned by batch_id:
+# - results:   the results table joined with runs and inputs, plus the product type of each offer
+# - confusion: per (product_type, attribute, target_value, llm_value) the number of rows and their
+#              average similarity score
+STORE_TABLES = ("results", "confusion")
+# File with the version (number of runs, latest updated_at, number of results) of every synced batch
+STORE_VERSIONS_FILE = "batches.json"
+
+
+### STORE FUNCTIONS ###
+def get_partition_path(table, batch_id, store_path=analytics_store_path):
+    """
+    Return the path of the Parquet file holding the given batch of a table.
+    """
+    return os.path.join(store_path, table, f"batch_id={batch_id}", "part-0.parquet")
+
+
+def load_store_versions(store_path=analytics_store_path):
+    """
+    Return the versions of the batches in the store as a dict of batch_id → version.
+    """
+    versions_path = os.path.join(store_path, STORE_VERSIONS_FILE)
+    if not os.path.exists(versions_path):
+        return {}
+    with open(versions_path, "r") as file:
+        return json.load(file)
+
+
+def save_store_versions(versions, store_path=analytics_store_path):
+    """
+    Write the versions of the batches in the store.
+    """
+    versions_path = os.path.join(store_path, STORE_VERSIONS_FILE)
+    with open(versions_path + ".tmp", "w") as file:
+        json.dump(versions, file, indent=2, sort_keys=True)
+    os.replace(versions_path + ".tmp", versions_path)
+
+
+def add_product_types(results_df):
+    """
+    Add the product type of the offer each row belongs to: the target product type for
+    matched and unmatched target rows, the LLM product type for unmatched LLM rows.
+    """
+    product_type_rows = results_df[results_df["attribute"] == "product_type"]
+
+    target_product_types = (
+        product_type_rows[product_type_rows["target_row_index"].notna()]
+        .set_index(["run_id", "target_row_index"])["target_value"]
+    )
+    llm_product_types = (
+        product_type_rows[product_type_rows["llm_row_index"].notna()]
+        .set_index(["run_id", "llm_row_index"])["llm_value"]
+    )
+
+    target_keys = pd.MultiIndex.from_arrays([results_df["run_id"], results_df["target_row_index"]])
+    llm_keys = pd.MultiIndex.from_arrays([results_df["run_id"], results_df["llm_row_index"]])
+    results_df["product_type"] = (
+        pd.Series(target_product_types.reindex(target_keys).values, index=results_df.index)
+        .fillna(pd.Series(llm_product_types.reindex(llm_keys).values, index=results_df.index))
+    )
+    return results_df
+
+
+def build_confusion_table(results_df):
+    """
+    Count the (target_value → llm_value) pairs per batch, product type and attribute.
+    """
+    return (
+        results_df
+        .groupby(["batch_id", "product_type", "attribute", "target_value", "llm_value"], dropna=False)
+        .agg(count=("similarity_score", "size"), avg_similarity_score=("similarity_score", "mean"))
+        .reset_index()
+    )
+
+
+def write_partition(df, table, batch_id, store_path=analytics_store_path):
+    """
+    Write one batch of a table, replacing the previous version of that batch atomically.
+    """
+    partition_path = get_partition_path(table, batch_id, store_path)
+    os.makedirs(os.path.dirname(partition_path), exist_ok=True)
+    df.to_parquet(partition_path + ".tmp", index=False)
+    os.replace(partition_path + ".tmp", partition_path)
+
+
+def sync_store(full=False, store_path=analytics_store_path):
+    """
+    Incrementally update the store from the database: only batches that are new or whose
+    runs or results changed since the last sync are loaded, batches that were deleted are removed.
+    Set full=True to rebuild every batch.
+    Returns the list of synced batch IDs.
+    """
+    os.makedirs(store_path, exist_ok=True)
+    stored_versions = {} if full else load_store_versions(store_path)
+
+    versions = {
+        row["batch_id"]: {
+            "num_runs": int(row["num_runs"]),
+            "updated_at": str(row["updated_at"]),
+            "num_results": int(row["num_results"])
+        }
+        for _, row in load_batch_versions().iterrows()
+    }
+
+    synced = []
+    for batch_id, version in sorted(versions.items()):
+        if stored_versions.get(batch_id) == version:
+            continue
+        print(f"Syncing batch {batch_id}...")
+        results_df = add_product_types(load_batch_results(batch_id))
+        write_partition(results_df, "results", batch_id, store_path)
+        write_partition(build_confusion_table(results_df), "confusion", batch_id, store_path)
+        synced.append(batch_id)
+
+    for batch_id in set(stored_versions) - set(versions):
+        print(f"Removing deleted batch {batch_id}...")
+        for table in STORE_TABLES:
+            shutil.rmtree(os.path.dirname(get_partition_path(table, batch_id, store_path)), ignore_errors=True)
+
+    save_store_versions(versions, store_path)
+    return synced
+
+
+def read_table(table, batch_ids=None, store_path=analytics_store_path):
+    """
+    Read a table of the store, optionally only the given batches, as a pandas DataFrame.
+    """
+    if batch_ids is None:
+        batch_ids = sorted(load_store_versions(store_path))
+
+    partitions = [
+        pd.read_parquet(get_partition_path(table, batch_id, store_path))
+        for batch_id in batch_ids
+        if os.path.exists(get_partition_path(table, batch_id, store_path))
+    ]
+    if not partitions:
+        raise ValueError(f"No data in the analytics store for batches {batch_ids}, run `python analytics.py sync` first.")
+    return pd.concat(partitions, ignore_index=True)
+
+
+### QUERY FUNCTIONS ###
+def filter_product_type(df, product_type):
+    """
+    Keep only rows whose product type contains the given text (case-insensitive).
+    """
+    if product_type is None:
+        return df
+    return df[df["product_type"].fillna("").str.contains(product_type, case=False, regex=False)]
+
+
+def get_confusion(attribute, product_type=None, batch_ids=None, mismatches_only=False, store_path=analytics_store_path):
+    """
+    Return the (target_value → llm_value) counts of an attribute, summed over the given
+    batches (all batches if None), optionally for one product type and only for mismatches.
+    """
+    confusion_df = read_table("confusion", batch_ids, store_path)
+    confusion_df = confusion_df[confusion_df["attribute"] == attribute]
+    confusion_df = filter_product_type(confusion_df, product_type)
+    if mismatches_only:
+        confusion_df = confusion_df[confusion_df["target_value"] != confusion_df["llm_value"]]
+
+    confusion_df = confusion_df.assign(similarity_sum=confusion_df["count"] * confusion_df["avg_similarity_score"])
+    confusion_df = (
+        confusion_df
+        .groupby(["target_value", "llm_value"], dropna=False)
+        .agg(count=("count", "sum"), similarity_sum=("similarity_sum", "sum"))
+        .reset_index()
+    )
+    confusion_df["avg_similarity_score"] = confusion_df["similarity_sum"] / confusion_df["count"]
+    return (
+        confusion_df
+        .drop(columns="similarity_sum")
+        .sort_values(["count", "target_value"], ascending=[False, True])
+        .reset_index(drop=True)
+    )
+
+
+def get_attribute_similarity(batch_ids=None, product_type=None, store_path=analytics_store_path):
+    """
+    Return the number of rows and the average similarity score per batch and attribute.
+    """
+    confusion_df = filter_product_type(read_table("confusion", batch_ids, store_path), product_type)
+    confusion_df = confusion_df.assign(similarity_sum=confusion_df["count"] * confusion_df["avg_similarity_score"])
+    attribute_df = (
+        confusion_df
+        .groupby(["batch_id", "attribute"])
+        .agg(count=("count", "sum"), similarity_sum=("similarity_sum", "sum"))
+        .reset_index()
+    )
+    attribute_df["avg_similarity_score"] = attribute_df["similarity_sum"] / attribute_df["count"]
+    return attribute_df.drop(columns="similarity_sum")
+
+
+def diff_batches(batch_a, batch_b, attribute=None, product_type=None, store_path=analytics_store_path):
+    """
+    Compare two batches. Without an attribute, returns the average similarity score per
+    attribute in both batches; with an attribute, returns the (target_value → llm_value)
+    counts in both batches. Rows are sorted by the largest change first.
+    """
+    if attribute is None:
+        attribute_df = get_attribute_similarity([batch_a, batch_b], product_type, store_path)
+        diff_df = attribute_df.pivot(index="attribute", columns="batch_id", values="avg_similarity_score")
+    else:
+        diff_df = pd.concat(
+            {
+                batch_id: get_confusion(attribute, product_type, [batch_id], store_path=store_path)
+                .set_index(["target_value", "llm_value"])["count"]
+                for batch_id in (batch_a, batch_b)
+            },
+            axis=1
+        ).fillna(0)
+
+    diff_df = diff_df.reindex(columns=[batch_a, batch_b]).rename_axis(columns=None)
+    diff_df["difference"] = diff_df[batch_b] - diff_df[batch_a]
+    return diff_df.sort_values("difference", key=abs, ascending=False).reset_index()
+
+
+### COMMAND LINE ###
+def get_analytics_args() -> argparse.Namespace:
+    """
+    Build and return the ArgumentParser namespace for the analytics command line.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Drill down into the validation results using a local copy of the results\n"
+            f"(Parquet files in {analytics_store_path}, partitioned by batch_id)."
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=(
+            "Example usage:\n"
+            "  python analytics.py sync\n"
+            "  python analytics.py confusion -a variety -p Cucumber --mismatches-only\n"
+            "  python analytics.py diff 20250610101541 20250610131111 -a variety\n"
+        )
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    sync_parser = subparsers.add_parser("sync", help="Update the local store with new and changed batches.")
+    sync_parser.add_argument("--full", action="store_true", help="Rebuild every batch.")
+
+    subparsers.add_parser("batches", help="List the batches in the local store.")
+
+    confusion_parser = subparsers.add_parser("confusion", help="Show target_value → llm_value counts of an attribute.")
+    confusion_parser.add_argument("-a", "--attribute", required=True, help="Attribute, e.g. variety.")
+    confusion_parser.add_argument("-p", "--product-type", help="Only offers whose product type contains this text.")
+    confusion_parser.add_argument("-b", "--batch-ids", metavar="BATCH_ID", nargs="+", help="Only these batches (default: all).")
+    confusion_parser.add_argument("--mismatches-only", action="store_true", help="Only pairs where the values differ.")
+    confusion_parser.add_argument("-n", "--top", type=int, default=25, help="Number of rows to show (default: 25).")
+
+    diff_parser = subparsers.add_parser("diff", help="Compare two batches per attribute, or per value pair of one attribute.")
+    diff_parser.add_argument("batch_a")
+    diff_parser.add_argument("batch_b")
+    diff_parser.add_argument("-a", "--attribute", help="Compare the target_value → llm_value counts of this attribute.")
+    diff_parser.add_argument("-p", "--product-type", help="Only offers whose product type contains this text.")
+    diff_parser.add_argument("-n", "--top", type=int, default=25, help="Number of rows to show (default: 25).")
+
+    return parser.parse_args()
+
+
+def main():
+    args = get_analytics_args()
+    with pd.option_context("display.max_rows", None, "display.width", 200, "display.max_colwidth", 60):
+        if args.command == "sync":
+            synced = sync_store(full=args.full)
+            print(f"Synced {len(synced)} batch(es).")
+        elif args.command == "batches":
+            versions = pd.DataFrame.from_dict(load_store_versions(), orient="index")
+            print(versions.rename_axis("batch_id") if not versions.empty else "The analytics store is empty.")
+        elif args.command == "confusion":
+            confusion_df = get_confusion(args.attribute, args.product_type, args.batch_ids, args.mismatches_only)
+            print(confusion_df.head(args.top))
+        elif args.command == "diff":
+            print(diff_batches(args.batch_a, args.batch_b, args.attribute, args.product_type).head(args.top))
+
+
+if __name__ == "__main__":
+    main()
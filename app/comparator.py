@@ -1,19 +1,12 @@
-import os
 import json
-import numpy as np
-import openai
-from Levenshtein import ratio as levenshtein_ratio
 import pandas as pd
-from utils import load_csv, load_inputs
-from datetime import datetime, timedelta
-from scipy.optimize import linear_sum_assignment
+from target_index import get_target_index
 from config import (
     REQUIRED_COLUMNS_TARGET,
     REQUIRED_COLUMNS_COMPARISON,
     NUMERIC_COLUMNS,
     SIMILARITY_WEIGHTS,
-    TEXT_COLUMNS,
-    labeled_data_path
+    TEXT_COLUMNS
 )
 
 
@@ -44,16 +37,15 @@ def select_comparison_columns(llm_output_df, target_output_df):
     llm_output_df = llm_output_df[REQUIRED_COLUMNS_COMPARISON]
     return llm_output_df, target_output_df
     
-def preprocess_data(llm_output_df, target_output_df):
+def preprocess_llm_output(llm_output_df):
     """
-    Preprocess the DataFrames by replacing 'unspecified' with NaN,
-    converting numeric fields, and normalizing date fields.
+    Preprocess the LLM output DataFrame by converting numeric fields (zeros and
+    non-numeric values become <NA>) and replacing 'N/A - unspecified' with 'unspecified'.
     """
     # 1) Coerce everything in numeric_cols to float64 (NaN for bad/non-numeric)
-    for df in (llm_output_df, target_output_df):
-        df[list(NUMERIC_COLUMNS)] = df[list(NUMERIC_COLUMNS)].apply(pd.to_numeric, errors='coerce')
-    
-    # 2) In the LLM frame: mask zeros and NaNs → <NA>
+    llm_output_df[list(NUMERIC_COLUMNS)] = llm_output_df[list(NUMERIC_COLUMNS)].apply(pd.to_numeric, errors='coerce')
+
+    # 2) Mask zeros and NaNs → <NA>
     for col in NUMERIC_COLUMNS:
         llm_output_df[col] = (
             llm_output_df[col]
@@ -61,24 +53,45 @@ def preprocess_data(llm_output_df, target_output_df):
             .astype('Float64')                                          # ensure nullable float
         )
 
-    # 3) In the target frame: mask NaNs → <NA> (but leave real zeros)
+    # 3) Replace 'N/A - unspecified' with 'unspecified' in string columns
+    for col in TEXT_COLUMNS:
+        llm_output_df[col] = llm_output_df[col].replace('N/A - unspecified', 'unspecified')
+    return llm_output_df
+
+
+def preprocess_target_output(target_output_df):
+    """
+    Preprocess the target output DataFrame by converting numeric fields (non-numeric
+    values become <NA>, real zeros are kept) and normalizing date fields.
+    """
+    # 1) Coerce everything in numeric_cols to float64 (NaN for bad/non-numeric)
+    target_output_df[list(NUMERIC_COLUMNS)] = target_output_df[list(NUMERIC_COLUMNS)].apply(pd.to_numeric, errors='coerce')
+
+    # 2) Mask NaNs → <NA> (but leave real zeros)
     for col in NUMERIC_COLUMNS:
         target_output_df[col] = (
             target_output_df[col]
             .mask(target_output_df[col].isna())  # only NaN → NA
             .astype('Float64')
         )
-    
-    # 4) Replace 'N/A - unspecified' with 'unspecified' in string columns
-    for col in TEXT_COLUMNS:
-        llm_output_df[col] = llm_output_df[col].replace('N/A - unspecified', 'unspecified')
-    
+
     # Ensure date_of_sending is a datetime object in the same time zone
-    target_output_df["date_of_sending"] = pd.to_datetime(
-        target_output_df["date_of_sending"],
-        format="%d-%m-%Y %H:%M:%S",  # or omit format and use dayfirst=True
-        errors="coerce"
-    )
+    if "date_of_sending" in target_output_df.columns:
+        target_output_df["date_of_sending"] = pd.to_datetime(
+            target_output_df["date_of_sending"],
+            format="%d-%m-%Y %H:%M:%S",  # or omit format and use dayfirst=True
+            errors="coerce"
+        )
+    return target_output_df
+
+
+def preprocess_data(llm_output_df, target_output_df):
+    """
+    Preprocess the DataFrames by replacing 'unspecified' with NaN,
+    converting numeric fields, and normalizing date fields.
+    """
+    llm_output_df = preprocess_llm_output(llm_output_df)
+    target_output_df = preprocess_target_output(target_output_df)
     return llm_output_df, target_output_df
 
 
@@ -92,6 +105,8 @@ def get_value_similarity(target_value, llm_value, column):
         - If target is NaN and LLM value is not NaN, score is 0.0 (mismatch)
     - For string columns: Levenshtein ratio (0–100)/100
     """
+    from Levenshtein import ratio as levenshtein_ratio
+
     # If one of the values is NaN, we handle it separately
     if column in TEXT_COLUMNS:
         if target_value == 'unspecified' or llm_value == 'unspecified':
@@ -165,6 +180,8 @@ def link_rows_hungarian(llm_output_df, target_output_df, min_score=0.0):
     then solve the one‐to‐one assignment that maximizes total similarity.
     Optionally discard any matched pair whose sim < min_score.
     """
+    import numpy as np
+
     n_targets = len(target_output_df)
     n_llm     = len(llm_output_df)
 
@@ -179,10 +196,22 @@ def link_rows_hungarian(llm_output_df, target_output_df, min_score=0.0):
                 SIMILARITY_WEIGHTS
             )
 
-    # 2) Solve assignment on -S to MAXIMIZE similarity
+    return assign_rows(S, min_score=min_score)
+
+def assign_rows(S, min_score=0.0):
+    """
+    Solve the one‐to‐one assignment that maximizes total similarity for a
+    similarity matrix S (shape: n_targets × n_llm).
+    Optionally discard any matched pair whose sim < min_score.
+    """
+    from scipy.optimize import linear_sum_assignment
+
+    n_targets = S.shape[0]
+
+    # 1) Solve assignment on -S to MAXIMIZE similarity
     row_idx, col_idx = linear_sum_assignment(-S)
 
-    # 3) Filter out any pairs below min_score
+    # 2) Filter out any pairs below min_score
     target_llm_links = {i: None for i in range(n_targets)}
     for i, j in zip(row_idx, col_idx):
         if S[i, j] >= min_score:
@@ -202,10 +231,12 @@ def get_unmatched_llm_rows(target_llm_links, llm_output_df):
     unmatched_llm_indices = [i for i in range(len(llm_output_df)) if i not in matched_indices]
     return unmatched_llm_indices
 
-def get_value_comparison_df(llm_output_df, target_output_df, target_llm_links):
+def get_value_comparison_df(llm_output_df, target_output_df, target_llm_links, value_similarity=None):
     """
     Create a DataFrame with the following columns: run_id, target_row_index, llm_row_index, column_name, target_value, llm_value, similarity_score
+    `value_similarity` optionally replaces get_value_similarity (same signature), e.g. by a cached version.
     """
+    value_similarity = value_similarity or get_value_similarity
     comparison_data = []
 
     # Iterate through the linked rows and calculate similarity for each required column
@@ -224,7 +255,7 @@ def get_value_comparison_df(llm_output_df, target_output_df, target_llm_links):
             else:
                 llm_value = llm_row[col]
 
-            similarity = get_value_similarity(target_value, llm_value, col)
+            similarity = value_similarity(target_value, llm_value, col)
             comparison_data.append({
                 "target_row_index": i,
                 "llm_row_index": j,
@@ -256,21 +287,14 @@ def get_value_comparison_df(llm_output_df, target_output_df, target_llm_links):
     return pd.DataFrame(comparison_data)
 
 ### Main Comparison Function ###
-def compare_llm_to_target_output(input, response):
+def compare_llm_to_target_output(input, response, target_match=None):
     """
     Validate the LLM output DataFrame against the target output.
     This function will check for required columns, preprocess data, and calculate similarity scores.
+    `target_match` is the TargetMatch of the input (see target_index.py); if omitted, the input
+    is resolved to its target rows here.
     """
-    # Retrieve metadata from the input DataFrame in order to match the target output with the LLM output
     input_id = input["id"].values[0]
-    supplier_name = input["supplier_name"].values[0]
-    date_of_sending = input["date_of_sending"].values[0]
-    email_adress = input["email_address"].values[0]
-    phone_number = input["phone_number"].values[0]
-    email_subject = input["email_subject"].values[0]
-
-    # Ensure date_of_sending is a datetime object and in the correct time zone
-    date_of_sending = pd.to_datetime(date_of_sending, errors="coerce") + pd.Timedelta(hours=1)
 
     # ───── Parse the JSON‐string into a Python object ─────────────────────────────
     if isinstance(response, str):
@@ -286,31 +310,22 @@ def compare_llm_to_target_output(input, response):
     except Exception as e:
         raise ValueError(f"Could not convert LLM output to DataFrame: {e}")
 
-    # Load the target output from the labeled data CSV
-    if not os.path.exists(labeled_data_path):
-        raise FileNotFoundError(f"Labeled data file not found: {labeled_data_path}")
-    target_output_df = load_csv(labeled_data_path)
-
-    # Ensure both DataFrames have the required columns and preprocess them
-    llm_output_df, target_output_df = check_required_columns(llm_output_df, target_output_df)
-    llm_output_df, target_output_df = preprocess_data(llm_output_df, target_output_df)
+    # Get the target rows of the input from the labeled data, matched on supplier_name,
+    # date_of_sending, email_address, email_subject and phone_number
+    if target_match is None:
+        target_match = get_target_index().resolve(input.iloc[0])
 
-    # Get rows from target_output where supplier_name, date_of_sending, email_adress, phone_number, email_subject match the input_id
-    relevant_target_rows = target_output_df[
-        (target_output_df["supplier_name"] == supplier_name) &
-        (target_output_df["date_of_sending"] == date_of_sending) &
-        (target_output_df["email_address"] == email_adress) &
-        #(target_output_df["phone_number"] == phone_number) & TO DO: be able to match phone numbers
-        (target_output_df["email_subject"] == email_subject)
-    ]
-    
     # If no matching rows are found, raise an error
-    if relevant_target_rows.empty:
+    if target_match is None:
         raise ValueError(f"No matching rows found in target output for input ID {input_id}.")
-    print("Found matching rows in target output for the given input_id.")
-    print(relevant_target_rows)
+    print(f"Found matching rows in target output for the given input_id ({target_match.method} match, confidence {target_match.confidence:.2f}).")
+    print(target_match.rows)
+
+    target_output_df = target_match.rows.copy()
 
-    target_output_df = relevant_target_rows.reset_index(drop=True)
+    # Ensure both DataFrames have the required columns and preprocess them
+    llm_output_df, target_output_df = check_required_columns(llm_output_df, target_output_df)
+    llm_output_df, target_output_df = preprocess_data(llm_output_df, target_output_df)
 
     # Select the relevant columns for comparison
     llm_output_df, target_output_df = select_comparison_columns(llm_output_df, target_output_df)
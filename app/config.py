@@ -8,6 +8,10 @@ manual_prompt_path = "../prompts/manual_prompt.txt"
 default_prompt_path = "../prompts/default_prompt.txt"
 # Path to the response schema JSON file
 response_schema_path = "../data/response_schema.json"
+# Path to the local cache of input metadata used by the argument parser
+inputs_manifest_path = "../data/inputs_manifest.json"
+# Seconds to wait for a database connection before giving up (e.g. during an outage)
+DATABASE_CONNECT_TIMEOUT_SECONDS = 5
 
 ### VALIDATION.py ###
 # Required columns for the target_output (labeled data)
@@ -37,4 +41,68 @@ TEXT_COLUMNS = {
 SIMILARITY_WEIGHTS = {
     "product_type": 2.0,
     "price": 2.0,
-}
\ No newline at end of file
+}
+
+### WORKER.py ###
+# A run that has been 'running' for longer than this without a heartbeat is re-queued as 'pending'
+RUN_LEASE_SECONDS = 900
+# How often a worker waiting for new runs polls the runs table
+WORKER_POLL_INTERVAL_SECONDS = 10
+
+
+### ANALYTICS.py ###
+# Directory of the local analytics store (Parquet files partitioned by batch_id)
+analytics_store_path = "../data/analytics"
+
+
+### TARGET_INDEX.py ###
+# Time zone of the date_of_sending values in the labeled data. The sheet is on a fixed UTC+1
+# (the inputs were matched with input + 1 hour before the target index); "Etc/GMT-1" is UTC+1
+# in the POSIX sign convention. Use "Europe/Amsterdam" if the sheet turns out to follow DST.
+LABELED_DATA_TIMEZONE = "Etc/GMT-1"
+# Time zone assumed for date_of_sending values in the inputs table without time zone information
+INPUTS_TIMEZONE = "UTC"
+# Weights of the fields used to match an input to its target rows when there is no exact match
+# (phone_number only counts when both the input and the target have one)
+TARGET_MATCH_WEIGHTS = {
+    "email_address": 2.0,
+    "date_of_sending": 2.0,
+    "supplier_name": 1.0,
+    "email_subject": 1.0,
+    "phone_number": 1.0,
+}
+# Difference in date_of_sending at which the time similarity drops to 0
+TARGET_MATCH_MAX_TIME_DIFFERENCE_HOURS = 3
+# Minimum confidence of a fuzzy match, and the minimum lead over the next best candidate
+TARGET_MATCH_MIN_CONFIDENCE = 0.8
+TARGET_MATCH_MIN_MARGIN = 0.05
+
+
+### RATE_LIMITER.py ###
+# Client-side OpenAI rate limits per process, adjusted at runtime from the x-ratelimit-* response headers
+OPENAI_REQUESTS_PER_MINUTE = 500
+OPENAI_TOKENS_PER_MINUTE = 30000
+# Tokens reserved for the response of a request (counted towards the tokens-per-minute limit)
+ESTIMATED_OUTPUT_TOKENS = 2000
+# Estimated input tokens per page of a PDF (extracted text and page image)
+PDF_TOKENS_PER_PAGE = 1500
+# Rough size of a PDF page, used to estimate the page count when the page tree cannot be read
+PDF_BYTES_PER_PAGE = 100 * 1024
+# Small requests are admitted first; a waiting request's priority doubles every this many seconds
+RATE_LIMIT_AGING_SECONDS = 30
+# How often a request that was rate limited (429) is retried
+RATE_LIMIT_MAX_RETRIES = 5
+# How often a running worker prints the rate limiter metrics
+RATE_LIMIT_METRICS_INTERVAL_SECONDS = 60
+
+
+### SPOOL.py ###
+# Directory of the local spool of run outcomes and results that are not yet written to the database
+spool_path = "../data/spool"
+# A spool segment is closed (and can be replayed) when it grows beyond this size
+SPOOL_SEGMENT_MAX_BYTES = 64 * 1024 * 1024
+# Appended records are fsync'ed in batches of this many records, or after this many seconds
+SPOOL_FSYNC_BATCH_SIZE = 8
+SPOOL_FSYNC_INTERVAL_SECONDS = 1.0
+# How often the background flusher replays the spool into the database
+SPOOL_FLUSH_INTERVAL_SECONDS = 5
@@ -1,10 +1,10 @@
 import time
+import asyncio
 from typing import Any
-from pydantic import BaseModel
-from openai import AsyncOpenAI
-from enum import Enum
 import os
 from dotenv import load_dotenv
+from rate_limiter import get_rate_limiter, estimate_request_tokens
+from config import RATE_LIMIT_MAX_RETRIES
 
 
 async def get_chat_gpt_response(
@@ -15,14 +15,18 @@ async def get_chat_gpt_response(
         encoded_image:str | None = None,
         encoded_pdf:str | None = None,
         ) -> Any:
-    
+    # The OpenAI client (and pydantic) are slow to import, so only do so when a request is made
+    from pydantic import BaseModel
+    from openai import AsyncOpenAI, RateLimitError, APIConnectionError, InternalServerError
+
     # Get API key
     load_dotenv()
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
     if OPENAI_API_KEY is None:
         raise RuntimeError("OPENAI_API_KEY not found—did you create a .env with that variable?")
 
-    client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    # Retries are handled below, so rate limited requests go through the rate limiter again
+    client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
 
     """Send a prompt and text to GPT and return its response."""
     content = []
@@ -48,15 +52,38 @@ async def get_chat_gpt_response(
             })
     
     
-    chat_response = await client.beta.chat.completions.parse(
-        model=model,
-        messages=[
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": content}
-        ],
-        temperature=0,
-        response_format=response_format
-    )
+    # Wait for the client-side rate limiter before sending, smaller requests go first
+    rate_limiter = get_rate_limiter()
+    estimated_tokens = estimate_request_tokens(system_prompt, text_to_analize, encoded_image, encoded_pdf)
+    for attempt in range(RATE_LIMIT_MAX_RETRIES + 1):
+        reserved_tokens = await rate_limiter.acquire(estimated_tokens)
+        try:
+            raw_response = await client.beta.chat.completions.with_raw_response.parse(
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": content}
+                ],
+                temperature=0,
+                response_format=response_format
+            )
+            break
+        except RateLimitError as e:
+            # The rejected request did not use the tokens reserved for it
+            rate_limiter.record_usage(reserved_tokens, 0)
+            # An exhausted quota will not recover by waiting
+            if attempt == RATE_LIMIT_MAX_RETRIES or e.code == "insufficient_quota":
+                raise
+            rate_limiter.throttle(e.response.headers)
+        except (APIConnectionError, InternalServerError):
+            rate_limiter.record_usage(reserved_tokens, 0)
+            if attempt == RATE_LIMIT_MAX_RETRIES:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+    chat_response = raw_response.parse()
+    rate_limiter.record_usage(reserved_tokens, chat_response.usage.total_tokens if chat_response.usage else reserved_tokens)
+    rate_limiter.update_from_headers(raw_response.headers)
 
     response_content = None
     if isinstance(response_format, dict):
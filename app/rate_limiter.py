@@ -0,0 +1,270 @@
+import re
+import time
+import zlib
+import base64
+import asyncio
+from io import BytesIO
+from collections import deque
+from functools import lru_cache
+from config import (
+    OPENAI_REQUESTS_PER_MINUTE,
+    OPENAI_TOKENS_PER_MINUTE,
+    ESTIMATED_OUTPUT_TOKENS,
+    PDF_TOKENS_PER_PAGE,
+    PDF_BYTES_PER_PAGE,
+    RATE_LIMIT_AGING_SECONDS,
+    RATE_LIMIT_METRICS_INTERVAL_SECONDS
+)
+
+
+### Token Estimation ###
+def estimate_text_tokens(text):
+    """
+    Rough token count of a text (~4 characters per token).
+    """
+    return len(text) // 4 + 1 if text else 0
+
+
+def estimate_image_tokens(encoded_image, detail="high"):
+    """
+    Token count of a base64 encoded image as charged by OpenAI: 85 base tokens plus 170 per
+    512px tile, after scaling the image to fit 2048x2048 and its shortest side to 768px.
+    """
+    from PIL import Image
+
+    if detail == "low":
+        return 85
+    try:
+        width, height = Image.open(BytesIO(base64.b64decode(encoded_image))).size
+    except Exception:
+        # Unknown size, assume the largest possible image
+        width, height = 2048, 2048
+
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return 85 + 170 * tiles
+
+
+def get_pdf_page_count(pdf_bytes):
+    """
+    Read the page count of a PDF from the /Count of its page tree, also when the page tree is
+    stored in a compressed object stream (PDF 1.5+). Returns None if no page tree is found.
+    """
+    # Page tree nodes do not contain nested dictionaries, so a flat << ... >> match is enough
+    dictionary = re.compile(rb"<<((?:(?!<<|>>).)*)>>", re.DOTALL)
+    object_stream = re.compile(rb"<<((?:(?!<<|>>).)*/Type\s*/ObjStm(?:(?!<<|>>).)*)>>\s*stream\r?\n", re.DOTALL)
+
+    sections = [pdf_bytes]
+    for match in object_stream.finditer(pdf_bytes):
+        if b"/FlateDecode" not in match.group(1):
+            continue
+        try:
+            sections.append(zlib.decompressobj().decompress(pdf_bytes[match.end():]))
+        except zlib.error:
+            continue
+
+    counts = [
+        int(count.group(1))
+        for section in sections
+        for match in dictionary.finditer(section)
+        if re.search(rb"/Type\s*/Pages\b", match.group(1))
+        for count in [re.search(rb"/Count\s+(\d+)", match.group(1))]
+        if count
+    ]
+    # The root of the page tree counts all pages
+    return max(counts) if counts else None
+
+
+def estimate_pdf_tokens(encoded_pdf):
+    """
+    Token count of a base64 encoded PDF, based on its number of pages. If the page tree
+    cannot be read, the number of pages is estimated from the size of the PDF.
+    """
+    pdf_bytes = base64.b64decode(encoded_pdf)
+    num_pages = get_pdf_page_count(pdf_bytes) or max(1, -(-len(pdf_bytes) // PDF_BYTES_PER_PAGE))
+    return num_pages * PDF_TOKENS_PER_PAGE
+
+
+def estimate_request_tokens(system_prompt, text_to_analize=None, encoded_image=None, encoded_pdf=None):
+    """
+    Estimate the tokens a chat completion request counts towards the tokens-per-minute limit.
+    """
+    tokens = estimate_text_tokens(system_prompt) + ESTIMATED_OUTPUT_TOKENS
+    if text_to_analize:
+        tokens += estimate_text_tokens(text_to_analize)
+    elif encoded_image:
+        tokens += estimate_image_tokens(encoded_image)
+    elif encoded_pdf:
+        tokens += estimate_pdf_tokens(encoded_pdf)
+    return tokens
+
+
+def parse_reset_duration(value):
+    """
+    Parse a x-ratelimit-reset-* header value (e.g. '1s', '6m0s', '20ms') into seconds.
+    """
+    units = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(amount) * units[unit] for amount, unit in re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value or ""))
+
+
+### Rate Limiter ###
+class RateLimiter:
+    """
+    Token-bucket admission control for OpenAI requests, with one bucket for requests and one
+    for tokens, both refilled continuously up to their per-minute limit. Waiting requests are
+    admitted smallest estimated token count first; the priority of a waiting request doubles
+    every RATE_LIMIT_AGING_SECONDS so large requests are not starved. The buckets are corrected
+    with the actual token usage and the x-ratelimit-* headers of every response, and admission
+    is paused after a 429 response.
+    """
+
+    def __init__(self, requests_per_minute=OPENAI_REQUESTS_PER_MINUTE, tokens_per_minute=OPENAI_TOKENS_PER_MINUTE):
+        self.request_capacity = requests_per_minute
+        self.token_capacity = tokens_per_minute
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.waiting = []
+
+        # Metrics
+        self.admitted_requests = 0
+        self.admitted_tokens = 0
+        self.throttle_events = 0
+        self.recent_admissions = deque()  # (time, tokens) of the admissions in the last minute
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.available_requests = min(self.request_capacity, self.available_requests + elapsed * self.request_capacity / 60)
+        self.available_tokens = min(self.token_capacity, self.available_tokens + elapsed * self.token_capacity / 60)
+
+    def get_priority(self, waiter, now):
+        tokens, enqueued_at = waiter
+        return tokens / 2 ** ((now - enqueued_at) / RATE_LIMIT_AGING_SECONDS)
+
+    def get_wait_time(self, tokens):
+        """
+        Seconds until the buckets hold enough for a request of the given size.
+        """
+        now = time.monotonic()
+        missing_requests = max(0.0, 1 - self.available_requests)
+        missing_tokens = max(0.0, tokens - self.available_tokens)
+        return max(
+            self.paused_until - now,
+            missing_requests * 60 / self.request_capacity,
+            missing_tokens * 60 / self.token_capacity,
+        )
+
+    async def acquire(self, estimated_tokens):
+        """
+        Wait until a request with the given estimated token count may be sent.
+        Returns the number of tokens taken from the token bucket.
+        """
+        waiter = (estimated_tokens, time.monotonic())
+        self.waiting.append(waiter)
+        try:
+            while True:
+                self.refill()
+                now = time.monotonic()
+                head = min(self.waiting, key=lambda w: self.get_priority(w, now))
+                # A request larger than the whole bucket is admitted once the bucket is full. The
+                # capacity can shrink while waiting (see update_from_headers), so clamp every time.
+                wait_time = self.get_wait_time(min(head[0], self.token_capacity))
+                if head is waiter and wait_time <= 0:
+                    break
+                await asyncio.sleep(min(max(wait_time, 0.01), 1.0))
+        finally:
+            # Remove by identity, waiters of the same size and time compare equal
+            self.waiting = [w for w in self.waiting if w is not waiter]
+
+        tokens = min(estimated_tokens, self.token_capacity)
+        self.available_requests -= 1
+        self.available_tokens -= tokens
+        self.admitted_requests += 1
+        self.admitted_tokens += tokens
+        self.recent_admissions.append((time.monotonic(), tokens))
+        return tokens
+
+    def record_usage(self, reserved_tokens, used_tokens):
+        """
+        Correct the token bucket with the actual token usage of an admitted request.
+        """
+        self.available_tokens = min(self.token_capacity, self.available_tokens + reserved_tokens - used_tokens)
+
+    def update_from_headers(self, headers):
+        """
+        Adjust the limits and buckets to the x-ratelimit-* headers of a response.
+        """
+        limit_requests = headers.get("x-ratelimit-limit-requests")
+        limit_tokens = headers.get("x-ratelimit-limit-tokens")
+        remaining_requests = headers.get("x-ratelimit-remaining-requests")
+        remaining_tokens = headers.get("x-ratelimit-remaining-tokens")
+
+        self.refill()
+        if limit_requests:
+            self.request_capacity = int(limit_requests)
+        if limit_tokens:
+            self.token_capacity = int(limit_tokens)
+        if remaining_requests:
+            self.available_requests = min(self.available_requests, float(remaining_requests))
+        if remaining_tokens:
+            self.available_tokens = min(self.available_tokens, float(remaining_tokens))
+
+    def throttle(self, headers=None):
+        """
+        Pause admission after a 429 response, for the retry-after time if given,
+        otherwise until the exhausted bucket is reset according to the headers.
+        """
+        headers = headers or {}
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            pause = float(retry_after)
+        else:
+            pause = max(
+                parse_reset_duration(headers.get("x-ratelimit-reset-requests")),
+                parse_reset_duration(headers.get("x-ratelimit-reset-tokens")),
+                1.0,
+            )
+        self.paused_until = max(self.paused_until, time.monotonic() + pause)
+        self.throttle_events += 1
+        print(f"Rate limited by OpenAI, pausing requests for {pause:.1f}s. {self.format_metrics()}")
+
+    def get_metrics(self):
+        """
+        Return the current queue depth, tokens admitted in the last minute and throttle count.
+        """
+        now = time.monotonic()
+        while self.recent_admissions and self.recent_admissions[0][0] < now - 60:
+            self.recent_admissions.popleft()
+        return {
+            "queue_depth": len(self.waiting),
+            "admitted_requests": self.admitted_requests,
+            "admitted_tokens": self.admitted_tokens,
+            "admitted_tpm": sum(tokens for _, tokens in self.recent_admissions),
+            "throttle_events": self.throttle_events,
+        }
+
+    def format_metrics(self):
+        return ", ".join(f"{name}={value}" for name, value in self.get_metrics().items())
+
+
+@lru_cache(maxsize=None)
+def get_rate_limiter():
+    """
+    Return the rate limiter shared by all requests of this process.
+    """
+    return RateLimiter()
+
+
+async def report_metrics(rate_limiter, interval=RATE_LIMIT_METRICS_INTERVAL_SECONDS):
+    """
+    Print the metrics of the rate limiter every `interval` seconds until cancelled.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        print(f"Rate limiter: {rate_limiter.format_metrics()}")
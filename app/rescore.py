@@ -0,0 +1,315 @@
+import uuid
+import argparse
+import numpy as np
+import pandas as pd
+from utils import load_results, load_llm_outputs, load_batch_versions, insert_derived_run, update_results
+from comparator import (
+    get_value_similarity,
+    get_value_comparison_df,
+    assign_rows,
+    preprocess_llm_output
+)
+from config import (
+    REQUIRED_COLUMNS_COMPARISON,
+    NUMERIC_COLUMNS,
+    SIMILARITY_WEIGHTS
+)
+
+# String representations of missing numeric values in the results table
+# (the values are stored with .astype(str), see worker.process_input)
+MISSING_VALUE_STRINGS = {"<NA>", "nan", "NaN", "None", ""}
+# Re-scored batches are stored as <source batch_id>-rescored-<timestamp>
+RESCORED_BATCH_MARKER = "-rescored-"
+
+
+class SimilarityCache:
+    """
+    Memoizes get_value_similarity per (attribute, target value, LLM value), keyed on the
+    values as stored in the results table, so every distinct pair is only scored once
+    across the runs of a batch. The cache can be seeded with the scores stored in the
+    results table for attributes whose similarity rules did not change; one cache is
+    used per source batch, as batches may have been scored with different rules.
+    """
+
+    def __init__(self):
+        self.scores = {}
+        self.computed = 0
+
+    def seed(self, results_df, attributes):
+        """
+        Seed the cache with the stored scores of matched rows for the given attributes.
+        """
+        matched = results_df[
+            results_df["target_row_index"].notna()
+            & results_df["llm_row_index"].notna()
+            & results_df["attribute"].isin(attributes)
+        ]
+        for attribute, target_value, llm_value, score in zip(
+            matched["attribute"], matched["target_value"], matched["llm_value"], matched["similarity_score"]
+        ):
+            self.scores[(attribute, target_value, llm_value)] = score
+
+    def __call__(self, target_value, llm_value, column):
+        key = (column, str(target_value), str(llm_value))
+        score = self.scores.get(key)
+        if score is None:
+            score = get_value_similarity(target_value, llm_value, column)
+            self.scores[key] = score
+            self.computed += 1
+        return score
+
+
+def parse_stored_value(value, column):
+    """
+    Convert a value as stored in the results table back to the type used by the comparator.
+    """
+    if column in NUMERIC_COLUMNS:
+        if value is None or value in MISSING_VALUE_STRINGS:
+            return pd.NA
+        try:
+            return float(value)
+        except ValueError:
+            return pd.NA
+    return value
+
+
+def build_output_df(run_results, index_column, value_column):
+    """
+    Rebuild the target (or LLM) output of a run from its per-attribute rows in the results table.
+    Every target row and every LLM row of a run is stored, either matched or unmatched.
+    """
+    rows = run_results[run_results[index_column].notna()]
+    output_df = (
+        rows.pivot_table(index=index_column, columns="attribute", values=value_column, aggfunc="first")
+        .sort_index()
+        .reset_index(drop=True)
+    )
+    output_df = output_df.reindex(columns=REQUIRED_COLUMNS_COMPARISON)
+    for col in REQUIRED_COLUMNS_COMPARISON:
+        output_df[col] = output_df[col].map(lambda value: parse_stored_value(value, col))
+    return output_df
+
+
+def llm_output_to_df(llm_output):
+    """
+    Convert a stored LLM output to the preprocessed DataFrame used for the comparison.
+    """
+    llm_output_df = pd.DataFrame(llm_output["product_offers"])
+    llm_output_df = llm_output_df.reindex(columns=REQUIRED_COLUMNS_COMPARISON)
+    return preprocess_llm_output(llm_output_df)
+
+
+def rescore_run(target_output_df, llm_output_df, weights, similarity):
+    """
+    Re-link the rows of a run with the given weights and return its value comparison DataFrame.
+    The weighted similarity matrix is built from one (cached) similarity matrix per attribute.
+    """
+    n_targets = len(target_output_df)
+    n_llm = len(llm_output_df)
+
+    S = np.zeros((n_targets, n_llm), dtype=float)
+    total_weight = 0
+    for col in REQUIRED_COLUMNS_COMPARISON:
+        weight = weights.get(col, 1.0)
+        attribute_scores = np.array(
+            [[similarity(target_value, llm_value, col) for llm_value in llm_output_df[col]]
+             for target_value in target_output_df[col]],
+            dtype=float
+        ).reshape(n_targets, n_llm)
+        S += weight * attribute_scores
+        total_weight += weight
+    if total_weight > 0:
+        S /= total_weight
+
+    target_llm_links = assign_rows(S, min_score=0.0)
+    return get_value_comparison_df(llm_output_df, target_output_df, target_llm_links, value_similarity=similarity)
+
+
+def is_rescored_batch(batch_id):
+    return RESCORED_BATCH_MARKER in batch_id
+
+
+def rescore_batches(batch_ids=None, weights=None, rules_changed=None, from_llm_output=False):
+    """
+    Re-score the stored results of the given batches without any LLM calls. If batch_ids is
+    None, all batches except earlier re-scored (derived) batches are re-scored.
+    - weights: similarity weights used to link target and LLM rows (default: SIMILARITY_WEIGHTS)
+    - rules_changed: attributes whose similarity rules changed. Scores of all other attributes
+      are taken from the results table of the same batch where possible. Pass
+      REQUIRED_COLUMNS_COMPARISON to recompute everything.
+    - from_llm_output: rebuild the LLM rows from runs.llm_output (with the current preprocessing)
+      instead of from the stored llm_value's.
+    Returns a dict of source batch_id → re-scored value comparison DataFrame, and the loaded results.
+    """
+    weights = SIMILARITY_WEIGHTS if weights is None else weights
+    rules_changed = set(rules_changed or [])
+    seed_attributes = [col for col in REQUIRED_COLUMNS_COMPARISON if col not in rules_changed]
+
+    if batch_ids is None:
+        batch_ids = [batch_id for batch_id in load_batch_versions()["batch_id"] if not is_rescored_batch(batch_id)]
+    results_df = load_results(batch_ids)
+    print(f"Loaded {len(results_df)} result rows of {results_df['run_id'].nunique()} runs.")
+
+    llm_outputs = load_llm_outputs(results_df["run_id"].unique()) if from_llm_output else {}
+
+    rescored = {}
+    computed = 0
+    seeded = 0
+    for batch_id, batch_results in results_df.groupby("batch_id", sort=True):
+        # Only the stored scores of this batch were computed with the rules its results are kept under
+        similarity = SimilarityCache()
+        similarity.seed(batch_results, seed_attributes)
+        seeded += len(similarity.scores)
+
+        batch_comparisons = []
+        for run_id, run_results in batch_results.groupby("run_id", sort=False):
+            target_output_df = build_output_df(run_results, "target_row_index", "target_value")
+            if from_llm_output:
+                llm_output_df = llm_output_to_df(llm_outputs[run_id])
+            else:
+                llm_output_df = build_output_df(run_results, "llm_row_index", "llm_value")
+
+            value_comparison_df = rescore_run(target_output_df, llm_output_df, weights, similarity)
+            value_comparison_df["source_run_id"] = run_id
+            value_comparison_df["settings"] = run_results["settings"].iloc[0]
+            batch_comparisons.append(value_comparison_df)
+        rescored[batch_id] = pd.concat(batch_comparisons, ignore_index=True)
+        computed += similarity.computed
+
+    print(f"Computed {computed} value similarities, {seeded} were seeded from the stored results.")
+    return rescored, results_df
+
+
+def save_rescored_batch(source_batch_id, value_comparison_df, settings):
+    """
+    Store the re-scored results of a batch as a new, derived batch with new runs that copy
+    the input, system prompt and LLM output of the source runs.
+    Returns the derived batch ID.
+    """
+    batch_id = f"{source_batch_id}{RESCORED_BATCH_MARKER}{pd.Timestamp.now().strftime('%Y%m%d%H%M%S')}"
+
+    run_ids = {}
+    for source_run_id, source_settings in value_comparison_df.groupby("source_run_id")["settings"].first().items():
+        run_ids[source_run_id] = str(uuid.uuid4())
+        insert_derived_run(run_ids[source_run_id], source_run_id, batch_id, f"{source_settings} | {settings}")
+
+    value_comparison_df = value_comparison_df.copy()
+    value_comparison_df["run_id"] = value_comparison_df["source_run_id"].map(run_ids)
+    value_comparison_df["batch_id"] = batch_id
+    value_comparison_df = value_comparison_df.drop(columns=["source_run_id", "settings"])
+    value_comparison_df["target_value"] = value_comparison_df["target_value"].astype(str)
+    value_comparison_df["llm_value"] = value_comparison_df["llm_value"].astype(str)
+    update_results(value_comparison_df)
+    return batch_id
+
+
+def parse_weights(values):
+    """
+    Parse `attribute=weight` pairs into a weights dict.
+    """
+    weights = {}
+    for value in values:
+        attribute, sep, weight = value.partition("=")
+        if not sep or attribute not in REQUIRED_COLUMNS_COMPARISON:
+            raise argparse.ArgumentTypeError(f"invalid weight '{value}', expected <attribute>=<weight>")
+        weights[attribute] = float(weight)
+    return weights
+
+
+def get_rescore_args() -> argparse.Namespace:
+    """
+    Build and return the ArgumentParser namespace for re-scoring.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Re-score stored results with new similarity weights or rules, without calling the LLM.\n"
+            "Each re-scored batch is written as a derived batch `<batch_id>-rescored-<timestamp>`."
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=(
+            "Example usage:\n"
+            "  python rescore.py -b 20250610131111 -w product_type=3 price=1 --dry-run\n"
+            "  python rescore.py --rules-changed variety sub_variety\n"
+        )
+    )
+    parser.add_argument(
+        "-b", "--batch-ids",
+        metavar="BATCH_ID",
+        nargs="+",
+        default=None,
+        help=(
+            "Batches to re-score. If omitted, all batches except earlier re-scored\n"
+            "batches are re-scored."
+        )
+    )
+    parser.add_argument(
+        "-w", "--weights",
+        metavar="ATTRIBUTE=WEIGHT",
+        nargs="+",
+        default=None,
+        help=(
+            "Similarity weights used to link target and LLM rows. Attributes that are\n"
+            f"not given get weight 1.0 (default: {SIMILARITY_WEIGHTS})."
+        )
+    )
+    parser.add_argument(
+        "--rules-changed",
+        metavar="ATTRIBUTE",
+        nargs="*",
+        default=None,
+        help=(
+            "Attributes whose similarity rules changed; their scores are recomputed.\n"
+            "Pass the flag without attributes to recompute all attributes."
+        )
+    )
+    parser.add_argument(
+        "--from-llm-output",
+        action="store_true",
+        help="Rebuild the LLM rows from runs.llm_output, e.g. after changing the preprocessing."
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print the old and new average similarity per batch, do not write anything."
+    )
+    args = parser.parse_args()
+
+    try:
+        args.weights = parse_weights(args.weights) if args.weights is not None else None
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    if args.rules_changed is not None:
+        invalid = set(args.rules_changed) - set(REQUIRED_COLUMNS_COMPARISON)
+        if invalid:
+            parser.error(f"argument --rules-changed: invalid attribute(s): {sorted(invalid)}")
+        if not args.rules_changed:
+            args.rules_changed = list(REQUIRED_COLUMNS_COMPARISON)
+    return args
+
+
+def main():
+    args = get_rescore_args()
+    weights = args.weights if args.weights is not None else SIMILARITY_WEIGHTS
+
+    rescored, results_df = rescore_batches(
+        batch_ids=args.batch_ids,
+        weights=weights,
+        rules_changed=args.rules_changed,
+        from_llm_output=args.from_llm_output
+    )
+
+    settings = f"rescored with weights {weights}"
+    if args.rules_changed:
+        settings += f", rules changed for {args.rules_changed}"
+
+    old_scores = results_df.groupby("batch_id")["similarity_score"].mean()
+    for source_batch_id, value_comparison_df in rescored.items():
+        new_score = value_comparison_df["similarity_score"].mean()
+        print(f"Batch {source_batch_id}: avg similarity {old_scores[source_batch_id]:.4f} → {new_score:.4f}")
+        if not args.dry_run:
+            batch_id = save_rescored_batch(source_batch_id, value_comparison_df, settings)
+            print(f"  Saved as batch {batch_id}.")
+
+
+if __name__ == "__main__":
+    main()
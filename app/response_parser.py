@@ -0,0 +1,110 @@
+import json
+from functools import lru_cache
+from utils import load_json
+from config import response_schema_path
+
+
+# Python types accepted for each JSON schema type. bool is excluded from the numeric types,
+# because json.loads only returns a bool for true/false.
+JSON_SCHEMA_TYPES = {
+    "object": (dict,),
+    "array": (list,),
+    "string": (str,),
+    "number": (int, float),
+    "integer": (int,),
+    "boolean": (bool,),
+    "null": (type(None),),
+}
+
+
+def compile_validator(schema, path="$"):
+    """
+    Compile a JSON schema into a validation function.
+    The schema is walked once; the returned function only runs the checks it needs and
+    raises a ValueError naming the offending location if the data does not conform.
+    Supports the subset of JSON schema used for structured outputs: type, properties,
+    required, additionalProperties (false) and items.
+    """
+    checks = []
+
+    schema_type = schema.get("type")
+    if schema_type is not None:
+        type_names = schema_type if isinstance(schema_type, list) else [schema_type]
+        allowed_types = tuple(t for name in type_names for t in JSON_SCHEMA_TYPES[name])
+        reject_bool = "boolean" not in type_names
+
+        def check_type(data, location):
+            if not isinstance(data, allowed_types) or (reject_bool and isinstance(data, bool)):
+                raise ValueError(f"{location}: expected {' or '.join(type_names)}, got {type(data).__name__}")
+        checks.append(check_type)
+
+    if "properties" in schema or "required" in schema:
+        property_validators = {
+            name: compile_validator(property_schema, f"{path}.{name}")
+            for name, property_schema in schema.get("properties", {}).items()
+        }
+        required = tuple(schema.get("required", ()))
+        allow_additional = schema.get("additionalProperties", True) is not False
+
+        def check_object(data, location):
+            if not isinstance(data, dict):
+                return
+            missing = [name for name in required if name not in data]
+            if missing:
+                raise ValueError(f"{location}: missing required properties {missing}")
+            for name, value in data.items():
+                validator = property_validators.get(name)
+                if validator is not None:
+                    validator(value, f"{location}.{name}")
+                elif not allow_additional:
+                    raise ValueError(f"{location}: unexpected property '{name}'")
+        checks.append(check_object)
+
+    if "items" in schema:
+        item_validator = compile_validator(schema["items"], f"{path}[]")
+
+        def check_items(data, location):
+            if not isinstance(data, list):
+                return
+            for i, item in enumerate(data):
+                item_validator(item, f"{location}[{i}]")
+        checks.append(check_items)
+
+    def validate(data, location=path):
+        for check in checks:
+            check(data, location)
+        return data
+
+    return validate
+
+
+@lru_cache(maxsize=None)
+def get_response_schema():
+    """
+    Load the response schema for the LLM output once per process.
+    """
+    return load_json(response_schema_path)
+
+
+@lru_cache(maxsize=None)
+def get_response_validator():
+    """
+    Compile the response schema into a validation function once per process.
+    """
+    return compile_validator(get_response_schema())
+
+
+def parse_llm_response(response):
+    """
+    Decode the raw JSON string returned by the LLM and validate it against the response schema.
+    Returns the decoded output, raises a ValueError if the output is malformed.
+    """
+    if isinstance(response, str):
+        try:
+            llm_output = json.loads(response)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"Could not decode LLM response as JSON: {e}")
+    else:
+        llm_output = response
+
+    return get_response_validator()(llm_output)
@@ -0,0 +1,265 @@
+import os
+import json
+import time
+import asyncio
+import threading
+from functools import lru_cache
+from config import (
+    spool_path,
+    SPOOL_SEGMENT_MAX_BYTES,
+    SPOOL_FSYNC_BATCH_SIZE,
+    SPOOL_FSYNC_INTERVAL_SECONDS,
+    SPOOL_FLUSH_INTERVAL_SECONDS
+)
+
+# Segments are named <time_ns>-<pid>.jsonl; the segment a process is appending to has an extra .open
+# suffix, and a segment that is being replayed has an extra .replaying-<pid of the replaying process> suffix
+SEGMENT_SUFFIX = ".jsonl"
+OPEN_SUFFIX = ".open"
+REPLAYING_SUFFIX = ".replaying-"
+
+
+def is_process_alive(pid):
+    """
+    Return True if a process with the given PID exists on this machine.
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class Spool:
+    """
+    Append-only local spool of run outcomes and results, written before the database so
+    the output of an LLM call is not lost when the database is unavailable. Records are
+    appended as JSON lines to a segment file and fsync'ed in batches; closed segments are
+    replayed into the runs and results tables and deleted once replayed. Replaying is
+    idempotent: an outcome is only written while its run is still running under the same
+    lease, together with the results of the run.
+    """
+
+    def __init__(self, path=spool_path):
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+        self.segment_path = None
+        self.segment_file = None
+        self.unsynced_records = 0
+        self.last_sync = time.monotonic()
+        # Segments are replayed in a thread (see run_flusher), one replay at a time per process
+        self.replay_lock = threading.Lock()
+        # Runs whose outcome this process spooled and has not replayed yet
+        self.unreplayed_runs = set()
+
+    ### Writing ###
+    def open_segment(self):
+        name = f"{time.time_ns()}-{os.getpid()}{SEGMENT_SUFFIX}{OPEN_SUFFIX}"
+        self.segment_path = os.path.join(self.path, name)
+        self.segment_file = open(self.segment_path, "a", encoding="utf-8")
+
+    def append(self, record):
+        """
+        Append a record to the current segment.
+        """
+        if self.segment_file is None:
+            self.open_segment()
+        self.segment_file.write(json.dumps(record) + "\n")
+        self.segment_file.flush()
+        self.unsynced_records += 1
+
+        if (self.unsynced_records >= SPOOL_FSYNC_BATCH_SIZE
+                or time.monotonic() - self.last_sync >= SPOOL_FSYNC_INTERVAL_SECONDS):
+            self.sync()
+        if self.segment_file.tell() >= SPOOL_SEGMENT_MAX_BYTES:
+            self.close_segment()
+
+    def sync(self):
+        """
+        fsync the records appended to the current segment.
+        """
+        if self.segment_file is not None and self.unsynced_records:
+            os.fsync(self.segment_file.fileno())
+        self.unsynced_records = 0
+        self.last_sync = time.monotonic()
+
+    def close_segment(self):
+        """
+        Sync and close the current segment, so it can be replayed.
+        """
+        if self.segment_file is None:
+            return
+        self.sync()
+        self.segment_file.close()
+        os.replace(self.segment_path, self.segment_path[:-len(OPEN_SUFFIX)])
+        self.segment_file = None
+        self.segment_path = None
+
+    def record_run_update(self, run_id, lease_id, status, llm_output=None, error_message=None, value_comparison_df=None):
+        """
+        Spool the outcome of a run, with the value comparison of the run if it completed,
+        see utils.update_run().
+        """
+        self.unreplayed_runs.add(str(run_id))
+        results = None
+        if value_comparison_df is not None:
+            results = value_comparison_df.astype(object).where(value_comparison_df.notna(), None).to_dict("records")
+        self.append({
+            "type": "run_update",
+            "run_id": str(run_id),
+            "lease_id": str(lease_id),
+            "status": status,
+            "llm_output": llm_output,
+            "error_message": error_message,
+            "results": results,
+        })
+
+    ### Replaying ###
+    def get_replayable_segments(self, include_orphaned=True):
+        """
+        Return the closed segments, and the open or replaying segments of processes that no
+        longer exist (e.g. after a crash), in the order they were created.
+        """
+        segments = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name.endswith(SEGMENT_SUFFIX):
+                segments.append(path)
+            elif not include_orphaned or path == self.segment_path:
+                continue
+            elif name.endswith(SEGMENT_SUFFIX + OPEN_SUFFIX):
+                pid = int(name.split("-")[1].split(".")[0])
+                if not is_process_alive(pid):
+                    segments.append(path)
+            elif REPLAYING_SUFFIX in name:
+                pid = int(name.rsplit(REPLAYING_SUFFIX, 1)[1])
+                if pid == os.getpid() or not is_process_alive(pid):
+                    segments.append(path)
+        return sorted(segments, key=os.path.basename)
+
+    def claim_segment(self, segment_path):
+        """
+        Claim a segment for replaying by atomically renaming it to <segment>.replaying-<pid>,
+        so no two processes replay the same segment concurrently.
+        Returns the path of the claimed segment, or None if another process claimed it first.
+        """
+        name = os.path.basename(segment_path)
+        segment_name = name[:name.index(SEGMENT_SUFFIX) + len(SEGMENT_SUFFIX)]
+        claimed_path = os.path.join(self.path, f"{segment_name}{REPLAYING_SUFFIX}{os.getpid()}")
+        try:
+            os.rename(segment_path, claimed_path)
+        except FileNotFoundError:
+            return None
+        return claimed_path
+
+    def release_segment(self, claimed_path):
+        """
+        Give up a claimed segment, so it is replayed later by any process.
+        """
+        os.replace(claimed_path, claimed_path[:claimed_path.rindex(REPLAYING_SUFFIX)])
+
+    def replay_segment(self, segment_path):
+        """
+        Write the records of a segment to the database and delete the segment.
+        Raises if a record cannot be written yet, the segment is then kept to be replayed later.
+        """
+        import pandas as pd
+        from utils import update_run, load_run_status
+
+        with open(segment_path, "r", encoding="utf-8") as file:
+            lines = file.readlines()
+
+        run_ids = []
+        for line_number, line in enumerate(lines, start=1):
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn write at the end of a segment of a crashed process
+                print(f"Skipping unreadable record {line_number} of spool segment {segment_path}.")
+                continue
+
+            run_ids.append(record["run_id"])
+            value_comparison_df = None
+            if record["results"] is not None:
+                value_comparison_df = pd.DataFrame(record["results"])
+                for col in ("target_row_index", "llm_row_index"):
+                    value_comparison_df[col] = value_comparison_df[col].astype("Int64")
+            if update_run(record["run_id"], record["lease_id"], record["status"], llm_output=record["llm_output"],
+                          error_message=record["error_message"], value_comparison_df=value_comparison_df):
+                continue
+
+            # The run was re-queued and claimed again, or already has an outcome (e.g. replayed before)
+            status = load_run_status(record["run_id"])
+            if record["status"] == "completed" and status == "running":
+                # Keep the LLM output until the other worker is done; if its lease expires as well,
+                # the run is pending again and the outcome is applied
+                raise RuntimeError(f"Run {record['run_id']} is being processed by another worker.")
+            if record["status"] == "failed" and status == "pending":
+                print(f"Run {record['run_id']} was re-queued, skipping its failed outcome.")
+
+        os.remove(segment_path)
+        self.unreplayed_runs.difference_update(run_ids)
+
+    def is_replayed(self, run_id):
+        """
+        Return True unless this process spooled an outcome of the run that it has not replayed yet.
+        """
+        return str(run_id) not in self.unreplayed_runs
+
+    def replay(self, include_orphaned=True):
+        """
+        Close the current segment and replay all replayable segments into the database.
+        Returns the number of replayed segments, see replay_segments().
+        """
+        self.close_segment()
+        return self.replay_segments(include_orphaned)
+
+    def replay_segments(self, include_orphaned=True):
+        """
+        Replay all replayable segments into the database, without touching the current segment,
+        so it can run in a thread while records are appended.
+        Returns the number of replayed segments; stops at the first segment that fails.
+        """
+        with self.replay_lock:
+            replayed = 0
+            for segment_path in self.get_replayable_segments(include_orphaned):
+                claimed_path = self.claim_segment(segment_path)
+                if claimed_path is None:
+                    # Claimed by another process in the meantime
+                    continue
+                try:
+                    self.replay_segment(claimed_path)
+                except Exception as e:
+                    print(f"Could not replay spool segment {segment_path}, it is kept for a later replay: {e}")
+                    self.release_segment(claimed_path)
+                    break
+                replayed += 1
+            return replayed
+
+    def get_pending_segments(self):
+        """
+        Return the number of segments that are not yet replayed.
+        """
+        return len([name for name in os.listdir(self.path) if SEGMENT_SUFFIX in name])
+
+
+@lru_cache(maxsize=None)
+def get_spool():
+    """
+    Return the spool of this process.
+    """
+    return Spool()
+
+
+async def run_flusher(spool, interval=SPOOL_FLUSH_INTERVAL_SECONDS):
+    """
+    Replay the spool into the database every `interval` seconds until cancelled. The current
+    segment is closed on the event loop, which appends to it; the replay itself runs in a
+    thread so a slow or unreachable database does not block the event loop.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        spool.close_segment()
+        await asyncio.to_thread(spool.replay_segments)
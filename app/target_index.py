@@ -0,0 +1,218 @@
+import re
+from dataclasses import dataclass
+from functools import lru_cache
+import pandas as pd
+from utils import load_csv
+from config import (
+    labeled_data_path,
+    LABELED_DATA_TIMEZONE,
+    INPUTS_TIMEZONE,
+    TARGET_MATCH_WEIGHTS,
+    TARGET_MATCH_MAX_TIME_DIFFERENCE_HOURS,
+    TARGET_MATCH_MIN_CONFIDENCE,
+    TARGET_MATCH_MIN_MARGIN
+)
+
+# Columns of the labeled data that identify the email (input) a target row belongs to
+TARGET_KEY_COLUMNS = ["supplier_name", "date_of_sending", "email_address", "email_subject"]
+
+
+### Normalization Functions ###
+def normalize_text(value):
+    """
+    Casefold and collapse whitespace, None for missing values.
+    """
+    if value is None or pd.isna(value):
+        return None
+    value = " ".join(str(value).split()).casefold()
+    return value or None
+
+
+def normalize_email(value):
+    """
+    Strip and lowercase an email address, None for missing values.
+    """
+    if value is None or pd.isna(value):
+        return None
+    value = str(value).strip().lower()
+    return value or None
+
+
+def normalize_phone(value):
+    """
+    Keep the last 9 digits of a phone number, so '+31 6-12345678', '0031612345678'
+    and '0612345678' are equal. None for missing values.
+    """
+    if value is None or pd.isna(value):
+        return None
+    digits = re.sub(r"\D", "", str(value))
+    return digits[-9:] or None
+
+
+def normalize_timestamp(value, timezone, dayfirst=False):
+    """
+    Convert a date_of_sending value to a UTC timestamp. Values without time zone
+    information are interpreted in the given time zone. None for missing values.
+    """
+    if value is None or pd.isna(value):
+        return None
+    timestamp = pd.to_datetime(value, dayfirst=dayfirst, errors="coerce")
+    if pd.isna(timestamp):
+        return None
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize(timezone, ambiguous="NaT", nonexistent="NaT")
+        if pd.isna(timestamp):
+            return None
+    return timestamp.tz_convert("UTC")
+
+
+def normalize_input(input_row):
+    """
+    Normalize the key fields of an input (a row of the inputs table).
+    """
+    return {
+        "supplier_name": normalize_text(input_row["supplier_name"]),
+        "date_of_sending": normalize_timestamp(input_row["date_of_sending"], INPUTS_TIMEZONE),
+        "email_address": normalize_email(input_row["email_address"]),
+        "email_subject": normalize_text(input_row["email_subject"]),
+        "phone_number": normalize_phone(input_row["phone_number"]),
+    }
+
+
+def get_field_similarity(field, input_value, target_value):
+    """
+    Similarity (0–1) of a key field of an input and a target, None if it cannot be compared.
+    """
+    from Levenshtein import ratio as levenshtein_ratio
+
+    if field == "phone_number" and (input_value is None or target_value is None):
+        return None
+    if input_value is None or target_value is None:
+        return 0.0
+    if field == "date_of_sending":
+        hours = abs((input_value - target_value).total_seconds()) / 3600
+        return max(0.0, 1.0 - hours / TARGET_MATCH_MAX_TIME_DIFFERENCE_HOURS)
+    if field == "phone_number":
+        return 1.0 if input_value == target_value else 0.0
+    return levenshtein_ratio(input_value, target_value)
+
+
+@dataclass
+class TargetMatch:
+    """
+    The target rows an input was resolved to, with the confidence (0–1) of the match
+    and the method ('exact' or 'fuzzy') that found it.
+    """
+    rows: pd.DataFrame
+    confidence: float
+    method: str
+
+
+class TargetIndex:
+    """
+    Index of the labeled data by email, built once so every input can be resolved to its
+    target rows before any LLM call is made. Inputs are first matched exactly on the
+    normalized supplier name, date of sending (in UTC), email address and subject, and
+    otherwise fuzzily on a weighted similarity of those fields and the phone number.
+    """
+
+    def __init__(self, target_output_df):
+        self.target_output_df = target_output_df.reset_index(drop=True)
+
+        # One group of target rows per email
+        self.groups = []
+        self.exact_keys = {}
+        grouped = self.target_output_df.groupby(TARGET_KEY_COLUMNS, dropna=False, sort=False)
+        for _, group in grouped:
+            first = group.iloc[0]
+            key_fields = {
+                "supplier_name": normalize_text(first["supplier_name"]),
+                "date_of_sending": normalize_timestamp(first["date_of_sending"], LABELED_DATA_TIMEZONE, dayfirst=True),
+                "email_address": normalize_email(first["email_address"]),
+                "email_subject": normalize_text(first["email_subject"]),
+                "phone_number": normalize_phone(first["phone_number"]),
+            }
+            self.exact_keys.setdefault(self.get_exact_key(key_fields), []).append(len(self.groups))
+            self.groups.append((key_fields, group.index))
+
+    @classmethod
+    def from_csv(cls, file_path=labeled_data_path):
+        """
+        Build the index from the labeled data CSV.
+        """
+        return cls(load_csv(file_path))
+
+    @staticmethod
+    def get_exact_key(key_fields):
+        return (
+            key_fields["supplier_name"],
+            key_fields["date_of_sending"],
+            key_fields["email_address"],
+            key_fields["email_subject"],
+        )
+
+    def get_rows(self, group_index):
+        return self.target_output_df.loc[self.groups[group_index][1]].reset_index(drop=True)
+
+    def score(self, input_fields, key_fields):
+        """
+        Weighted similarity (0–1) of the key fields of an input and of a target email.
+        """
+        weighted_sum = 0.0
+        total_weight = 0.0
+        for field, weight in TARGET_MATCH_WEIGHTS.items():
+            similarity = get_field_similarity(field, input_fields[field], key_fields[field])
+            if similarity is None:
+                continue
+            weighted_sum += weight * similarity
+            total_weight += weight
+        return weighted_sum / total_weight if total_weight > 0 else 0.0
+
+    def resolve(self, input_row):
+        """
+        Resolve an input (a row of the inputs table) to its target rows.
+        Returns a TargetMatch, or None if no (unambiguous) match is found.
+        """
+        input_fields = normalize_input(input_row)
+
+        exact = self.exact_keys.get(self.get_exact_key(input_fields), [])
+        if len(exact) == 1:
+            return TargetMatch(self.get_rows(exact[0]), 1.0, "exact")
+
+        scores = sorted(
+            ((self.score(input_fields, key_fields), group_index) for group_index, (key_fields, _) in enumerate(self.groups)),
+            reverse=True
+        )
+        if not scores:
+            return None
+        best_score, best_group = scores[0]
+        second_score = scores[1][0] if len(scores) > 1 else 0.0
+        if best_score < TARGET_MATCH_MIN_CONFIDENCE or best_score - second_score < TARGET_MATCH_MIN_MARGIN:
+            return None
+        return TargetMatch(self.get_rows(best_group), best_score, "fuzzy")
+
+    def resolve_all(self, inputs):
+        """
+        Resolve every input of the inputs DataFrame and print a report.
+        Returns a dict of input_id → TargetMatch (or None if the input cannot be matched).
+        """
+        matches = {}
+        for _, input_row in inputs.iterrows():
+            input_id = int(input_row["id"])
+            match = self.resolve(input_row)
+            matches[input_id] = match
+            if match is None:
+                print(f"Input ID {input_id}: no matching rows found in target output.")
+            elif match.method == "fuzzy":
+                print(f"Input ID {input_id}: fuzzy match with {len(match.rows)} target row(s), confidence {match.confidence:.2f}.")
+        num_matched = sum(match is not None for match in matches.values())
+        print(f"Matched {num_matched} of {len(matches)} input(s) to the target output.")
+        return matches
+
+
+@lru_cache(maxsize=None)
+def get_target_index():
+    """
+    Build the target index from the labeled data once per process.
+    """
+    return TargetIndex.from_csv(labeled_data_path)
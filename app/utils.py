@@ -1,38 +1,59 @@
 import os
-import pandas as pd
 import sys
+import json
 import argparse
 from argparse import RawTextHelpFormatter
-import base64
-from io import BytesIO
-import pandas as pd
-import os
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, text
-import pandas as pd
-import os
-from config import manual_prompt_path
+from config import manual_prompt_path, inputs_manifest_path, DATABASE_CONNECT_TIMEOUT_SECONDS
+
+# pandas and SQLAlchemy are imported inside the functions that need them, so that
+# `python main.py --help` and argument errors return without paying their import cost.
 
-# Load database URL from .env file
-load_dotenv()
-database_url = os.getenv("DATABASE_URL")
-if database_url is None:
-    raise RuntimeError("DATABASE_URL not found—did you create a .env with that variable?")
+# Columns of the inputs table that are cached in the local manifest (everything except the value)
+INPUT_MANIFEST_COLUMNS = ["id", "supplier_name", "source_type", "date_of_sending", "value_type"]
 
-# Create a SQLAlchemy engine to run SQL queries
-engine = create_engine(database_url)
+# SQLAlchemy engine, created on first use by get_engine()
+engine = None
 
 ### DATABASE FUNCTIONS ###
-def load_inputs():
+def get_engine():
+    """
+    Return the SQLAlchemy engine, creating it on first use.
+    """
+    global engine
+    if engine is None:
+        from sqlalchemy import create_engine
+
+        # Load database URL from .env file
+        load_dotenv()
+        database_url = os.getenv("DATABASE_URL")
+        if database_url is None:
+            raise RuntimeError("DATABASE_URL not found—did you create a .env with that variable?")
+
+        # Create a SQLAlchemy engine to run SQL queries, failing fast when the database is unreachable
+        engine = create_engine(database_url, connect_args={"connect_timeout": DATABASE_CONNECT_TIMEOUT_SECONDS})
+    return engine
+
+
+def load_inputs(input_ids=None):
     """
     Load inputs table from the database and return as a pandas DataFrame.
+    If input_ids is given, only those rows are loaded.
     """
-    # Select all data from the 'inputs' table
-    query = "SELECT * FROM inputs;"  
+    import pandas as pd
+    from sqlalchemy import text
+
+    # Select all data from the 'inputs' table, optionally restricted to the given IDs
+    if input_ids is None:
+        query = text("SELECT * FROM inputs;")
+        params = {}
+    else:
+        query = text("SELECT * FROM inputs WHERE id = ANY(:input_ids);")
+        params = {"input_ids": [int(input_id) for input_id in input_ids]}
 
     # Run the query and load into a DataFrame
     try:
-        df = pd.read_sql(query, con=engine)
+        df = pd.read_sql(query, con=get_engine(), params=params)
         print(df)
         return df
     except Exception as e:
@@ -40,35 +61,78 @@ def load_inputs():
         return None
 
 
-def insert_run(run_id, input_id, system_prompt, batch_id=None, settings=None):
+def load_input_manifest(refresh=False):
+    """
+    Return the input metadata (see INPUT_MANIFEST_COLUMNS) as a list of dicts, sorted by ID.
+    The metadata is cached in a local JSON manifest so that the argument parser does not
+    need a database connection. Set refresh=True to rebuild the manifest from the database.
+    """
+    if not refresh and os.path.exists(inputs_manifest_path):
+        with open(inputs_manifest_path, "r") as file:
+            return json.load(file)
+
+    import pandas as pd
+    from sqlalchemy import text
+
+    # Select only the metadata columns, the values themselves can be large
+    query = text(f"SELECT {', '.join(INPUT_MANIFEST_COLUMNS)} FROM inputs ORDER BY id;")
+    df = pd.read_sql(query, con=get_engine())
+    return save_input_manifest(df)
+
+
+def save_input_manifest(inputs_df):
+    """
+    Rebuild the local input manifest from a DataFrame of (all) inputs.
+    Returns the manifest, see load_input_manifest().
+    """
+    import pandas as pd
+
+    manifest = [
+        {
+            column: (int(row[column]) if column == "id" else (None if pd.isna(row[column]) else str(row[column])))
+            for column in INPUT_MANIFEST_COLUMNS
+        }
+        for _, row in inputs_df.sort_values("id").iterrows()
+    ]
+    with open(inputs_manifest_path, "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def insert_run(run_id, input_id, system_prompt, batch_id=None, settings=None, status="pending", error_message=None):
     """
     Record a run in the database with the given input ID and system prompt.
+    Runs are pending by default, i.e. queued to be processed by a worker.
     Returns True if successful, False otherwise.
     """
+    import pandas as pd
+    from sqlalchemy import text
+
     # Prepare the data to insert
     run_data = {
         "id": run_id,
         "input_id": input_id,
         "batch_id": batch_id,
         "system_prompt": system_prompt,
-        "status": "pending",
+        "status": status,
         "settings": None,
         "created_at": pd.Timestamp.now(),
         "updated_at": pd.Timestamp.now(),
         "llm_output": None,
-        "settings": settings
+        "settings": settings,
+        "error_message": error_message
     }
 
     # Create engine and perform INSERT
     insert_sql = text("""
         INSERT INTO public.runs
-            (id, input_id, batch_id, system_prompt, status, settings, created_at, updated_at, llm_output)
+            (id, input_id, batch_id, system_prompt, status, settings, created_at, updated_at, llm_output, error_message)
         VALUES
-            (:id, :input_id, :batch_id, :system_prompt, :status, :settings, :created_at, :updated_at, :llm_output)
+            (:id, :input_id, :batch_id, :system_prompt, :status, :settings, :created_at, :updated_at, :llm_output, :error_message)
     """)
 
     try:
-        with engine.begin() as conn: 
+        with get_engine().begin() as conn: 
             conn.execute(insert_sql, run_data)
     except Exception as e:
         print("Error inserting into runs table:", e)
@@ -77,51 +141,297 @@ def insert_run(run_id, input_id, system_prompt, batch_id=None, settings=None):
     return True
 
 
-def update_run(batch_id, input_id, status, llm_output=None, error_message=None):
+def update_run(run_id, lease_id, status, llm_output=None, error_message=None, value_comparison_df=None):
     """
-    Update the status (and LLM output) of the most recent run for the given input ID.
-    Returns True if successful, False otherwise.
+    Record the outcome of a running run. The update only applies while the run is still
+    running under the given lease (see claim_run), so a late outcome of a worker whose lease
+    expired does not overwrite the run after another worker claimed it. A completed outcome
+    is also applied when the run was re-queued but not claimed again yet, so a finished LLM
+    call is not repeated (e.g. when the outcome is replayed from the spool after an outage).
+    If value_comparison_df is given, the results of the run are written in the same
+    transaction, and only if the run was updated.
+    Returns True if the run was updated, False otherwise (see load_run_status for why not).
     """
+    import pandas as pd
+    from sqlalchemy import text
+
     # Prepare the data to update
     update_data = {
-        "batch_id": batch_id,
-        "input_id": input_id,
+        "run_id": str(run_id),
+        "lease_id": str(lease_id),
         "status": status,
         "llm_output": llm_output,
         "updated_at": pd.Timestamp.now(),
         "error_message": error_message
     }
 
-    # Create engine and perform UPDATE
+    # Perform the UPDATE, fenced on the run still being running under this lease
     update_sql = text("""
         UPDATE public.runs
             SET status     = :status,
                 llm_output = :llm_output,
                 updated_at = :updated_at,
-                error_message = :error_message     
-            WHERE input_id = :input_id AND batch_id = :batch_id
+                error_message = :error_message
+            WHERE id = CAST(:run_id AS UUID)
+              AND (
+                  (status = 'running' AND lease_id = CAST(:lease_id AS UUID))
+                  OR (status = 'pending' AND CAST(:status AS TEXT) = 'completed')
+              )
     """)
 
-    try:
-        with engine.begin() as conn: 
-            conn.execute(update_sql, update_data)
-    except Exception as e:
-        print("Error updating runs table:", e)
-        return False
-    return True
+    with get_engine().begin() as conn:
+        updated = conn.execute(update_sql, update_data).rowcount == 1
+        if updated and value_comparison_df is not None:
+            write_results(conn, value_comparison_df)
+    return updated
 
 
-def update_results(value_comparison_df):
+def claim_run(batch_id=None):
+    """
+    Claim the next pending run (optionally of the given batch) by marking it as running.
+    Uses FOR UPDATE SKIP LOCKED, so any number of workers can claim runs concurrently
+    without claiming the same run twice. Every claim gets a new lease_id, which the
+    heartbeats and the outcome of the run are fenced on (see touch_run and update_run).
+    Returns the claimed run as a dict (id, batch_id, input_id, system_prompt, lease_id) or None.
+    """
+    from sqlalchemy import text
+
+    claim_sql = text("""
+        UPDATE public.runs
+            SET status     = 'running',
+                lease_id   = gen_random_uuid(),
+                updated_at = now()
+            WHERE id = (
+                SELECT id
+                    FROM public.runs
+                    WHERE status = 'pending'
+                      AND (CAST(:batch_id AS TEXT) IS NULL OR batch_id = CAST(:batch_id AS TEXT))
+                    ORDER BY batch_id, input_id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+            )
+        RETURNING id, batch_id, input_id, system_prompt, lease_id
+    """)
+
+    with get_engine().begin() as conn:
+        row = conn.execute(claim_sql, {"batch_id": batch_id}).mappings().first()
+    if row is None:
+        return None
+    run = dict(row)
+    run["id"] = str(run["id"])
+    run["lease_id"] = str(run["lease_id"])
+    return run
+
+
+def touch_run(run_id, lease_id):
+    """
+    Renew the lease on a running run, so it is not re-queued while it is still being processed.
+    Returns True if the run is still running under this lease, False if it is not (its
+    outcome was written, or it was re-queued). Raises if the database cannot be reached.
+    """
+    from sqlalchemy import text
+
+    touch_sql = text("""
+        UPDATE public.runs
+            SET updated_at = now()
+            WHERE id = CAST(:run_id AS UUID)
+              AND lease_id = CAST(:lease_id AS UUID)
+              AND status = 'running'
+    """)
+
+    with get_engine().begin() as conn:
+        result = conn.execute(touch_sql, {"run_id": run_id, "lease_id": lease_id})
+    return result.rowcount == 1
+
+
+def load_run_status(run_id):
+    """
+    Return the status of a run, or None if the run does not exist.
+    """
+    from sqlalchemy import text
+
+    with get_engine().connect() as conn:
+        return conn.execute(
+            text("SELECT status FROM public.runs WHERE id = CAST(:run_id AS UUID)"),
+            {"run_id": str(run_id)}
+        ).scalar()
+
+
+def requeue_stale_runs(lease_seconds, batch_id=None):
+    """
+    Set runs that have been running without a heartbeat for longer than lease_seconds
+    back to pending, so another worker can claim them. Their lease is cleared, which
+    fences off the worker that lost it (see touch_run and update_run).
+    Returns the number of re-queued runs.
+    """
+    from sqlalchemy import text
+
+    requeue_sql = text("""
+        UPDATE public.runs
+            SET status     = 'pending',
+                lease_id   = NULL,
+                updated_at = now()
+            WHERE status = 'running'
+              AND updated_at < now() - make_interval(secs => :lease_seconds)
+              AND (CAST(:batch_id AS TEXT) IS NULL OR batch_id = CAST(:batch_id AS TEXT))
+    """)
+
+    with get_engine().begin() as conn:
+        result = conn.execute(requeue_sql, {"lease_seconds": lease_seconds, "batch_id": batch_id})
+    return result.rowcount
+
+
+def write_results(conn, value_comparison_df):
+    """
+    Write the value comparison of one or more runs to the results table on the given connection.
+    Existing results of those runs are replaced, so writing the results of a run twice
+    does not leave duplicate rows.
+    """
+    from sqlalchemy import text
+
+    run_ids = [str(run_id) for run_id in value_comparison_df["run_id"].unique()]
+    conn.execute(
+        text("DELETE FROM public.results WHERE run_id = ANY(CAST(:run_ids AS UUID[]))"),
+        {"run_ids": run_ids}
+    )
     # Finally, push it to the `results` table.  This will INSERT all rows in one go.
     value_comparison_df.to_sql(
         "results", 
-        con=engine, 
+        con=conn, 
         if_exists="append", 
         index=False  # don’t write the DataFrame’s index as a separate column
     )
+
+
+def update_results(value_comparison_df):
+    """
+    Write the value comparison of one or more runs to the results table, replacing
+    existing results of those runs (see write_results).
+    """
+    with get_engine().begin() as conn:
+        write_results(conn, value_comparison_df)
     return
 
 
+def load_results(batch_ids=None):
+    """
+    Load the results table, joined with the settings of each run, as a pandas DataFrame.
+    If batch_ids is given, only the results of those batches are loaded.
+    """
+    import pandas as pd
+    from sqlalchemy import text
+
+    query = """
+        SELECT results.run_id, results.batch_id, results.target_row_index, results.llm_row_index,
+               results.attribute, results.target_value, results.llm_value, results.similarity_score,
+               runs.input_id, runs.settings
+            FROM public.results
+            JOIN public.runs ON runs.id = results.run_id
+    """
+    params = {}
+    if batch_ids is not None:
+        query += " WHERE results.batch_id = ANY(:batch_ids)"
+        params["batch_ids"] = list(batch_ids)
+
+    df = pd.read_sql(text(query), con=get_engine(), params=params)
+    df["run_id"] = df["run_id"].astype(str)
+    return df
+
+
+def load_llm_outputs(run_ids):
+    """
+    Load the stored LLM output of the given runs.
+    Returns a dict of run_id → decoded LLM output.
+    """
+    from sqlalchemy import text
+
+    query = text("SELECT id, llm_output FROM public.runs WHERE id = ANY(CAST(:run_ids AS UUID[]))")
+    with get_engine().connect() as conn:
+        rows = conn.execute(query, {"run_ids": [str(run_id) for run_id in run_ids]}).all()
+
+    llm_outputs = {}
+    for run_id, llm_output in rows:
+        # Older runs stored the LLM output as a JSON encoded string
+        if isinstance(llm_output, str):
+            llm_output = json.loads(llm_output)
+        llm_outputs[str(run_id)] = llm_output
+    return llm_outputs
+
+
+def load_batch_versions():
+    """
+    Return a DataFrame with one row per batch: batch_id, number of runs, latest updated_at of
+    its runs and number of results, used to detect which batches changed since the last sync.
+    Results are written after their runs, so the number of results is part of the version.
+    """
+    import pandas as pd
+    from sqlalchemy import text
+
+    query = text("""
+        WITH run_versions AS (
+            SELECT batch_id, COUNT(*) AS num_runs, MAX(updated_at) AS updated_at
+                FROM public.runs
+                GROUP BY batch_id
+        ), result_counts AS (
+            SELECT batch_id, COUNT(*) AS num_results
+                FROM public.results
+                GROUP BY batch_id
+        )
+        SELECT run_versions.batch_id, run_versions.num_runs, run_versions.updated_at,
+               COALESCE(result_counts.num_results, 0) AS num_results
+            FROM run_versions
+            LEFT JOIN result_counts ON result_counts.batch_id = run_versions.batch_id
+    """)
+    return pd.read_sql(query, con=get_engine())
+
+
+def load_batch_results(batch_id):
+    """
+    Load the results of a batch joined with their runs and inputs as a pandas DataFrame.
+    """
+    import pandas as pd
+    from sqlalchemy import text
+
+    query = text("""
+        SELECT results.run_id, results.batch_id, results.target_row_index, results.llm_row_index,
+               results.attribute, results.target_value, results.llm_value, results.similarity_score,
+               runs.input_id, runs.settings, runs.status,
+               inputs.supplier_name, inputs.source_type, inputs.value_type
+            FROM public.results
+            JOIN public.runs ON runs.id = results.run_id
+            LEFT JOIN public.inputs ON inputs.id = runs.input_id
+            WHERE results.batch_id = :batch_id
+    """)
+    df = pd.read_sql(query, con=get_engine(), params={"batch_id": batch_id})
+    df["run_id"] = df["run_id"].astype(str)
+    return df
+
+
+def insert_derived_run(run_id, source_run_id, batch_id, settings):
+    """
+    Record a completed run that copies the input, system prompt and LLM output of an existing
+    run, e.g. to store re-scored results of that run under a new batch.
+    Returns True if successful, False otherwise.
+    """
+    from sqlalchemy import text
+
+    insert_sql = text("""
+        INSERT INTO public.runs
+            (id, input_id, batch_id, system_prompt, status, settings, created_at, updated_at, llm_output)
+        SELECT CAST(:id AS UUID), input_id, :batch_id, system_prompt, 'completed', :settings, now(), now(), llm_output
+            FROM public.runs
+            WHERE id = CAST(:source_run_id AS UUID)
+    """)
+
+    try:
+        with get_engine().begin() as conn:
+            conn.execute(insert_sql, {"id": run_id, "source_run_id": source_run_id, "batch_id": batch_id, "settings": settings})
+    except Exception as e:
+        print("Error inserting into runs table:", e)
+        return False
+    return True
+
+
 def dispose_engine():
     """
     Dispose the SQLAlchemy engine to release resources.
@@ -138,6 +448,8 @@ def load_csv(file_path):
     """
     Load a CSV file into a pandas DataFrame.
     """
+    import pandas as pd
+
     #print(f"Loading {file_path}...")
     if os.path.exists(file_path):
         df = pd.read_csv(file_path)
@@ -146,6 +458,16 @@ def load_csv(file_path):
     else:
         raise FileNotFoundError(f"{file_path} not found")
 
+def load_json(file_path):
+    """
+    Load a JSON file.
+    """
+    if os.path.exists(file_path):
+        with open(file_path, "r") as file:
+            return json.load(file)
+    else:
+        raise FileNotFoundError(f"{file_path} not found")
+
 def load_prompt(file_path: str) -> str:
     """
     Load a prompt from a text file.
@@ -158,36 +480,37 @@ def load_prompt(file_path: str) -> str:
 
 
 ### ARGUMENT PARSER FUNCTION ###
-def get_args(inputs) -> argparse.Namespace:
+def get_args() -> argparse.Namespace:
     """
     Build and return the ArgumentParser namespace.
     If run with no flags, prints help and exits.
     
-    Assumes `inputs` is a pandas DataFrame with columns:
-      - id
-      - supplier_name
-      - source_type
-      - date_of_sending
+    The list of valid input IDs (and the metadata shown in the help text) is read from
+    the local input manifest, see load_input_manifest(). The manifest is rebuilt from the
+    database when --refresh-inputs is passed or when an unknown input ID is requested.
     """
     # ——————————————
     # 1. Prepare the list of valid IDs + metadata for help text
     # ——————————————
-    # Sort by 'id' so the help listing appears in ascending order
-    # sorted_df = inputs.sort_values("id").reset_index(drop=True)
-    sorted_df = inputs
-    all_ids = sorted_df["id"].tolist()
+    # --refresh-inputs has to be known before the manifest is loaded, so pre-parse it
+    pre_parser = argparse.ArgumentParser(add_help=False)
+    pre_parser.add_argument("--refresh-inputs", action="store_true")
+    refresh_inputs = pre_parser.parse_known_args()[0].refresh_inputs
+
+    try:
+        manifest = load_input_manifest(refresh=refresh_inputs)
+    except Exception as e:
+        sys.exit(f"Could not load the available input IDs from the database: {e}")
+    all_ids = [row["id"] for row in manifest]
 
     # Build one formatted line per row:
     #   “  • 101 (SupplierA, TypeX, 2025-05-20)”
     lines = []
-    for _, row in sorted_df.iterrows():
-        id_val = row["id"]
-        supplier = row["supplier_name"]
-        src_type = row["source_type"]
-        date_sent = row["date_of_sending"]
-        value_type = row["value_type"] 
-        date_str = str(date_sent)  # In case it's a Timestamp
-        lines.append(f"  • {id_val} ({supplier}, {src_type}, {date_str}, {value_type})")
+    for row in manifest:
+        lines.append(
+            f"  • {row['id']} ({row['supplier_name']}, {row['source_type']}, "
+            f"{row['date_of_sending']}, {row['value_type']})"
+        )
 
     formatted_ids = "\n".join(lines)
 
@@ -236,14 +559,42 @@ def get_args(inputs) -> argparse.Namespace:
         metavar="ID",
         type=int,
         nargs="*",
-        choices=all_ids,
-        default=all_ids,
         help=(
             "Specify one or more input IDs to validate (e.g. `-i 1 2 3`).\n"
             "If omitted, all available IDs will be validated."
         )
     )
 
+    # — Refresh the cached input manifest from the database  —
+    parser.add_argument(
+        "--refresh-inputs",
+        action="store_true",
+        help=(
+            "Rebuild the local input manifest from the inputs table before\n"
+            "listing and validating input IDs."
+        )
+    )
+
+    # — Only enqueue the runs, to be processed by worker.py  —
+    parser.add_argument(
+        "--enqueue-only",
+        action="store_true",
+        help=(
+            "Only insert the batch's runs as pending and exit. The runs are then\n"
+            "processed by one or more `python worker.py -b <batch_id>` processes."
+        )
+    )
+
+    # — Recover spooled results, e.g. after a crash or database outage  —
+    parser.add_argument(
+        "--replay-spool",
+        action="store_true",
+        help=(
+            "Write the run outcomes and results left in the local spool (data/spool)\n"
+            "to the database and exit."
+        )
+    )
+
     # — If no flags are provided, show help and exit  —
     if len(sys.argv) == 1:
         parser.print_help(sys.stderr)
@@ -257,11 +608,24 @@ def get_args(inputs) -> argparse.Namespace:
         parser.error("When using `-p manual`, you must also pass `-s 'description of adjustments'`.\n"
                      "Example: `python main.py -p manual -s 'Added product type rule for Aubergine.'`")
 
+    # If no inputs are given, validate all of them. args.inputs is left None: the manifest may
+    # miss inputs that were added since it was built, main.py loads all inputs from the database
+    if args.inputs is None:
+        return args
+
+    # Unknown IDs may have been added to the database after the manifest was cached
+    unknown_ids = set(args.inputs) - set(all_ids)
+    if unknown_ids and not refresh_inputs:
+        try:
+            all_ids = [row["id"] for row in load_input_manifest(refresh=True)]
+        except Exception as e:
+            parser.error(f"argument -i/--inputs: unknown ID(s) {sorted(unknown_ids)}, and the available input IDs "
+                         f"could not be refreshed from the database: {e}")
+        unknown_ids = set(args.inputs) - set(all_ids)
+    if unknown_ids:
+        parser.error(f"argument -i/--inputs: invalid choice(s): {sorted(unknown_ids)} (see --help for available IDs)")
+
     # Set args.inputs to an ordered list of unique items to maintain order
-    if args.inputs is not None:
-        args.inputs = sorted(set(args.inputs))
+    args.inputs = sorted(set(args.inputs))
 
     return args
-
-
-
@@ -0,0 +1,310 @@
+import time
+import asyncio
+import argparse
+from llm_data_extractor import get_chat_gpt_response
+from utils import (
+    load_inputs,
+    dispose_engine,
+    claim_run,
+    touch_run,
+    requeue_stale_runs
+)
+from response_parser import get_response_schema, parse_llm_response
+from rate_limiter import get_rate_limiter, report_metrics
+from spool import get_spool, run_flusher
+from config import (
+    RUN_LEASE_SECONDS,
+    WORKER_POLL_INTERVAL_SECONDS
+)
+
+
+async def process_input(input_df, batch_id, run_id, lease_id, system_prompt):
+    """
+    Perform LLM data extraction and validation for a single input and store the outcome.
+    `input_df` is the (single row) inputs DataFrame of the input, the run is expected
+    to be claimed under `lease_id` already (see utils.claim_run). The outcome is written
+    to the local spool, from which it is replayed into the database (see spool.py).
+    """
+    import pandas as pd
+    from comparator import compare_llm_to_target_output
+    from target_index import get_target_index
+
+    spool = get_spool()
+
+    input_id = int(input_df["id"].values[0])
+    print(f"Processing input ID: {input_id}")
+    # Get the value and value type for the input ID
+    value = input_df["value"].values[0]
+    value_type = input_df["value_type"].values[0]
+    # If the value is None, skip this input_id
+    if pd.isna(value):
+        print(f"Input ID {input_id} has no value. Skipping.")
+        spool.record_run_update(run_id, lease_id, status="failed", llm_output=None, error_message="No value provided in inputs table.")
+        return
+    else:
+        # Get the user prompt based on the value type
+        if value_type == "img" or value_type == "pdf" or value_type == "txt":
+            user_prompt = value
+        elif value_type == "xlsx":
+            # TODO: Handle Excel files
+            print(f"Input ID {input_id} is an Excel file. Skipping.")
+            spool.record_run_update(run_id, lease_id, status="failed", llm_output=None, error_message="Excel files are not supported for this run.")
+            return
+        else:
+            print(f"Input ID {input_id} has an unsupported value type: {value_type}.")
+            spool.record_run_update(run_id, lease_id, status="failed", llm_output=None, error_message=f"Unsupported value type: {value_type}.")
+            return
+
+    # Resolve the input to its target rows before calling the LLM
+    target_match = get_target_index().resolve(input_df.iloc[0])
+    if target_match is None:
+        print(f"Input ID {input_id} has no matching rows in the target output. Skipping.")
+        spool.record_run_update(run_id, lease_id, status="failed", llm_output=None, error_message="No matching rows found in target output.")
+        return
+
+    # Response schema for the LLM output, loaded once per process
+    response_schema = get_response_schema()
+
+    # Now call the LLM
+    print(f"Calling LLM for input ID {input_id} with value type {value_type}...")
+    try:
+        response = await get_chat_gpt_response(
+            system_prompt=system_prompt,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "response_schema",
+                    "schema": response_schema
+                }
+            },
+            model="gpt-4o",
+            text_to_analize=(user_prompt if value_type == "txt" else None),
+            encoded_image=(user_prompt if value_type == "img" else None),
+            encoded_pdf=(user_prompt if value_type == "pdf" else None),
+        )
+
+    except Exception as e:
+        # Something went wrong in the LLM call:
+        print(f"Error processing input {input_id}: {e}")
+        # Mark this run as 'failed'
+        spool.record_run_update(run_id, lease_id, status="failed", llm_output=None, error_message=str(e))
+        return
+
+    # Decode the response once and validate it against the response schema
+    try:
+        llm_output = parse_llm_response(response)
+    except ValueError as e:
+        print(f"Malformed LLM output for input ID {input_id}: {e}")
+        spool.record_run_update(run_id, lease_id, status="failed", llm_output=None, error_message=f"Malformed LLM output: {e}")
+        return
+
+    # Compare the LLM output to the target output
+    print(f"Comparing LLM output to target output for input ID {input_id}...")
+    try:
+        value_comparison_df = compare_llm_to_target_output(input_df, llm_output, target_match=target_match)
+    except Exception as e:
+        print(f"Error comparing LLM output to target output for input ID {input_id}: {e}")
+        # Mark this run as 'failed'
+        spool.record_run_update(run_id, lease_id, status="failed", llm_output=response, error_message=str(e))
+        return
+
+    value_comparison_df["run_id"] = run_id
+    value_comparison_df["batch_id"] = batch_id
+    # Set all target_value and llm_value to string type so they can be stored in the database
+    # This is necessary because the database does not support numerical and string values in the same column
+    value_comparison_df["target_value"] = value_comparison_df["target_value"].astype(str)
+    value_comparison_df["llm_value"] = value_comparison_df["llm_value"].astype(str)
+
+    # Mark this run completed and save the validation results to database, together so a
+    # run is never completed without its results. The raw JSON string is stored as is,
+    # there is no need to encode the decoded output again.
+    spool.record_run_update(run_id, lease_id, status="completed", llm_output=response, error_message=None,
+                            value_comparison_df=value_comparison_df)
+
+    print(f"Completed processing for input ID {input_id}.")
+
+
+async def keep_lease(run_id, lease_id, lease_seconds, processed):
+    """
+    Renew the lease on a run every third of the lease time until the run is processed (the
+    `processed` event is set) and its outcome is replayed from the spool into the database,
+    so the run is not re-queued while its outcome is only in the spool. Stops early when the
+    run is no longer running under this lease.
+    """
+    spool = get_spool()
+    next_renewal = time.monotonic() + lease_seconds / 3
+    while not (processed.is_set() and spool.is_replayed(run_id)):
+        await asyncio.sleep(1)
+        if time.monotonic() < next_renewal:
+            continue
+        next_renewal = time.monotonic() + lease_seconds / 3
+        try:
+            if not await asyncio.to_thread(touch_run, run_id, lease_id):
+                return
+        except Exception as e:
+            print(f"Error renewing the lease on run {run_id}: {e}")
+
+
+async def run_worker(batch_id=None, inputs=None, lease_seconds=RUN_LEASE_SECONDS,
+                     poll_interval=WORKER_POLL_INTERVAL_SECONDS, wait=False, concurrency=1):
+    """
+    Claim pending runs from the runs table and process them until the queue is empty.
+    If batch_id is given, only runs of that batch are claimed. `inputs` is an optional
+    DataFrame of already loaded inputs, other inputs are loaded from the database per run.
+    If wait is True, keep polling for new runs instead of stopping when the queue is empty.
+    With concurrency > 1, that many runs are processed at the same time; the OpenAI requests
+    are then admitted by the rate limiter (see rate_limiter.py).
+    Returns the number of processed runs.
+    """
+    # Replay the spooled outcomes into the database in the background
+    spool = get_spool()
+    flusher_task = asyncio.create_task(run_flusher(spool))
+    # Leases of processed runs whose outcome is not replayed yet
+    lease_tasks = set()
+    # Report the rate limiter metrics while running, a waiting worker never returns
+    metrics_task = asyncio.create_task(report_metrics(get_rate_limiter()))
+    try:
+        processed = sum(await asyncio.gather(*[
+            process_queue(batch_id, inputs, lease_seconds, poll_interval, wait, lease_tasks)
+            for _ in range(concurrency)
+        ]))
+    finally:
+        flusher_task.cancel()
+        metrics_task.cancel()
+        await asyncio.to_thread(spool.replay)
+        for lease_task in list(lease_tasks):
+            lease_task.cancel()
+        pending = spool.get_pending_segments()
+        if pending:
+            print(f"{pending} spool segment(s) could not be written to the database yet. "
+                  "Replay them with: python main.py --replay-spool")
+    print(f"Rate limiter: {get_rate_limiter().format_metrics()}")
+    return processed
+
+
+async def process_queue(batch_id, inputs, lease_seconds, poll_interval, wait, lease_tasks):
+    """
+    Claim and process runs one at a time, see run_worker(). The lease of a processed run is
+    kept in `lease_tasks` until its outcome is replayed into the database.
+    Returns the number of processed runs.
+    """
+    spool = get_spool()
+    processed = 0
+    while True:
+        # The database may be briefly unavailable; back off instead of raising, which would
+        # cancel the runs that other coroutines of this worker are processing. The database
+        # calls run in a thread, so they do not block the event loop.
+        try:
+            # Runs of crashed or stuck workers are put back in the queue
+            requeued = await asyncio.to_thread(requeue_stale_runs, lease_seconds, batch_id=batch_id)
+            if requeued:
+                print(f"Re-queued {requeued} run(s) with an expired lease.")
+
+            run = await asyncio.to_thread(claim_run, batch_id=batch_id)
+        except Exception as e:
+            print(f"Error claiming a run, retrying in {poll_interval}s: {e}")
+            await asyncio.sleep(poll_interval)
+            continue
+
+        if run is None:
+            if not wait:
+                break
+            await asyncio.sleep(poll_interval)
+            continue
+
+        input_id = run["input_id"]
+        if inputs is not None and input_id in inputs["id"].values:
+            input_df = inputs[inputs["id"] == input_id]
+        else:
+            input_df = await asyncio.to_thread(load_inputs, [input_id])
+        if input_df is None:
+            # The input could not be loaded (see load_inputs); the run is re-queued once its lease expires
+            print(f"Could not load input ID {input_id}, retrying in {poll_interval}s.")
+            await asyncio.sleep(poll_interval)
+            continue
+        if input_df.empty:
+            spool.record_run_update(run["id"], run["lease_id"], status="failed", llm_output=None, error_message="Input not found in inputs table.")
+            continue
+
+        # Renew the lease while the run is being processed and until its outcome is replayed
+        processed_event = asyncio.Event()
+        lease_task = asyncio.create_task(keep_lease(run["id"], run["lease_id"], lease_seconds, processed_event))
+        lease_tasks.add(lease_task)
+        lease_task.add_done_callback(lease_tasks.discard)
+        try:
+            await process_input(input_df, run["batch_id"], run["id"], run["lease_id"], run["system_prompt"])
+        finally:
+            processed_event.set()
+        processed += 1
+
+        # After processing, dispose of the database engine
+        dispose_engine()
+
+    return processed
+
+
+def get_worker_args() -> argparse.Namespace:
+    """
+    Build and return the ArgumentParser namespace for the worker.
+    """
+    parser = argparse.ArgumentParser(
+        description=(
+            "Claim pending runs from the runs table and process them. Start any number of "
+            "workers (on any number of machines) against the same database to split a batch."
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+        epilog=(
+            "Example usage:\n"
+            "  python main.py -p default --enqueue-only\n"
+            "  python worker.py -b 20250610131111\n"
+        )
+    )
+    parser.add_argument(
+        "-b", "--batch-id",
+        type=str,
+        default=None,
+        help="Only claim runs of this batch. If omitted, runs of any batch are claimed."
+    )
+    parser.add_argument(
+        "--lease-seconds",
+        type=int,
+        default=RUN_LEASE_SECONDS,
+        help=(
+            "Re-queue runs that have been running without a heartbeat for this many seconds\n"
+            f"(default: {RUN_LEASE_SECONDS})."
+        )
+    )
+    parser.add_argument(
+        "-c", "--concurrency",
+        type=int,
+        default=1,
+        help="Number of runs to process at the same time (default: 1)."
+    )
+    parser.add_argument(
+        "--wait",
+        action="store_true",
+        help="Keep polling for new runs instead of exiting when the queue is empty."
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=WORKER_POLL_INTERVAL_SECONDS,
+        help=f"Seconds between polls when waiting for new runs (default: {WORKER_POLL_INTERVAL_SECONDS})."
+    )
+    return parser.parse_args()
+
+
+async def main():
+    args = get_worker_args()
+    processed = await run_worker(
+        batch_id=args.batch_id,
+        lease_seconds=args.lease_seconds,
+        poll_interval=args.poll_interval,
+        wait=args.wait,
+        concurrency=args.concurrency
+    )
+    print(f"Worker finished, processed {processed} run(s).")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -8,9 +8,13 @@ CREATE TABLE public.runs (
     created_at    TIMESTAMPTZ NOT NULL   DEFAULT now(),
     updated_at    TIMESTAMPTZ NOT NULL   DEFAULT now(),
     LLM_output    JSONB       DEFAULT '{}'::jsonb,
-    error_message TEXT        DEFAULT NULL
+    error_message TEXT        DEFAULT NULL,
+    lease_id      UUID        DEFAULT NULL   -- set by every claim, fences off workers whose lease expired
 );
 
+-- Existing databases:
+ALTER TABLE public.runs ADD COLUMN IF NOT EXISTS lease_id UUID DEFAULT NULL;
+
 
 
 